@@ -28,6 +28,10 @@ import Queue as queue
 import traceback
 
 import bisect
+import itertools
+import collections
+# For Python 3.x
+import __builtin__ as __builtin__
 from asynchia.util import (
     EMPTY_BYTES, is_unconnected, socketpair, b, LookupStack, is_closed
 )
@@ -36,9 +40,21 @@ from asynchia.const import trylater, connection_lost, inprogress
 __version__ = '0.1.3'
 
 
+if hasattr(__builtin__, 'memoryview'):
+    def _view(data, offset):
+        """ Return the data from offset on without copying it. """
+        return memoryview(data)[offset:]
+else:
+    _view = buffer
+
+
 class SocketMapClosedError(Exception):
     pass
 
+
+class SocketMapFullError(Exception):
+    pass
+
 def _unawait_conn(obj):
     """ Helper function for Notifier. """
     obj.stop_awaiting_connect()
@@ -579,6 +595,25 @@ class SocketTransport(Transport):
             else:
                 raise
     
+    if hasattr(os, 'sendfile'):
+        def sendfile(self, fd, offset, nbytes):
+            """ Send up to nbytes bytes of the file fd starting at offset.
+            The data is passed on to the socket by the kernel without
+            being copied into the process. Only available if the os
+            module has sendfile. """
+            try:
+                return os.sendfile(
+                    self.socket.fileno(), fd.fileno(), offset, nbytes
+                )
+            except OSError, err:
+                if err.args[0] in trylater:
+                    return 0
+                elif err.args[0] == errno.EPIPE:
+                    self.socket_map.notifier.close_obj(self)
+                    return 0
+                else:
+                    raise
+    
     def peek(self, buffer_size):
         return self.recv(buffer_size, socket.MSG_PEEK)
     
@@ -606,7 +641,9 @@ class SocketTransport(Transport):
                 self.handle_error()
     
     def is_closed(self):
-        return is_closed(self.socket)
+        # Once handle_close has been called there is no need to probe
+        # the socket again.
+        return self.closed or is_closed(self.socket)
 
 
 class SendallTrait(object):
@@ -616,9 +653,16 @@ class SendallTrait(object):
         class SendAllTransport(asynchia.SendallTrait, asynchia.SocketTransport):
             pass
     """
+    # Consecutive chunks shorter than this are joined until they are at
+    # least this long so that many small ones do not cost a send each.
+    send_size = 65536
+    
     def __init__(self, *args, **kwargs):
         super(SendallTrait, self).__init__(*args, **kwargs)
-        self.__buf = EMPTY_BYTES
+        # The chunks passed to sendall that have not been sent yet and
+        # how much of the first one has been sent.
+        self.__buf = collections.deque()
+        self.__offset = 0
         self.__savewriteable = None
     
     def set_writeable(self, value):
@@ -638,7 +682,8 @@ class SendallTrait(object):
         if not self.__buf:
             self.__savewritable = self.writeable
         self.set_writeable(True)
-        self.__buf += data
+        if data:
+            self.__buf.append(data)
     
     def handle_write(self):
         """ Internal. """
@@ -649,9 +694,37 @@ class SendallTrait(object):
         
             if self.handler is not None and self.writeable:
                 super(SendallTrait, self).handle_write()
-        if self.__buf:
-            sent = super(SendallTrait, self).send(self.__buf)
-            self.__buf = self.__buf[sent:]
+        buf = self.__buf
+        if buf:
+            send_size = self.send_size
+            offset = self.__offset
+            first = buf[0]
+            size = len(first) - offset
+            if not offset and (size >= send_size or len(buf) == 1):
+                data = first
+            elif size >= send_size:
+                # Send the rest of the chunk without copying it, which
+                # would make sending a large chunk quadratic. This is
+                # the only case in which send is not passed a string.
+                data = _view(first, offset)
+            else:
+                # Only short chunks are joined, so that at most
+                # send_size bytes are copied.
+                chunks = [first[offset:]]
+                for chunk in itertools.islice(buf, 1, None):
+                    if size >= send_size or len(chunk) >= send_size:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+                if len(chunks) == 1:
+                    data = chunks[0]
+                else:
+                    data = EMPTY_BYTES.join(chunks)
+            offset += super(SendallTrait, self).send(data)
+            # Only drop the data once it was sent.
+            while buf and offset >= len(buf[0]):
+                offset -= len(buf.popleft())
+            self.__offset = offset
     
     writeable = property(get_writeable, set_writeable)
 
@@ -16,7 +16,10 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import os
+import stat
+import struct
 # For Python 3.x
 import __builtin__ as __builtin__
 
@@ -138,6 +141,14 @@ class StringInput(Input):
         return self.length
 
 
+def _unbound(method):
+    """ Return the function of method, which is unbound on Python 2. """
+    return getattr(method, '__func__', method)
+
+
+_SOCKET_SEND = _unbound(asynchia.SocketTransport.send)
+
+
 class FileInput(Input):
     """ Input that buffers at most buffer_size bytes read from the passed fd,
     and sends them in a buffered way. This can be used to "directly" send data
@@ -155,10 +166,25 @@ class FileInput(Input):
         
         self.buf = EMPTY_BYTES
         self.eof = False
+        # Whether the file can be sent with sendfile, which is decided
+        # the first time it could be. If so, the offset of the data not
+        # sent yet and the size of the file.
+        self.sendfile = None
+        self.offset = self.filesize = None
     
     def tick(self, sock):
         """ Send as much of the file as possible. """
         Input.tick(self, sock)
+        # Transports that can send straight from the file do so, unless
+        # data read before is still waiting to be sent. Transports that
+        # override send, e.g. to transform the data, do not, as sendfile
+        # would bypass it.
+        sendfile = getattr(sock, 'sendfile', None)
+        if (sendfile is not None and self.length is not None and
+            not self.buf and _unbound(type(sock).send) is _SOCKET_SEND and
+            self.can_sendfile()):
+            return self.tick_sendfile(sendfile)
+        
         if not self.eof and len(self.buf) < self.buffer_size:
             read = self.fd.read(self.buffer_size - len(self.buf))
             if not read:
@@ -174,6 +200,44 @@ class FileInput(Input):
         
         return self.eof and not self.buf, sent
     
+    def can_sendfile(self):
+        """ Return whether the file can be sent using sendfile. This is
+        only the case for regular files; pipes, sockets and file-like
+        objects without a file descriptor are read from instead. """
+        if self.sendfile is None:
+            try:
+                status = os.fstat(self.fd.fileno())
+                self.sendfile = stat.S_ISREG(status.st_mode)
+                if self.sendfile:
+                    self.offset = self.fd.tell()
+                    self.filesize = status.st_size
+            except (AttributeError, OSError, IOError,
+                    io.UnsupportedOperation):
+                self.sendfile = False
+        return self.sendfile
+    
+    def tick_sendfile(self, sendfile):
+        """ Send as much of the file as possible using sendfile. """
+        sent = sendfile(
+            self.fd, self.offset, max(self.length, self.buffer_size)
+        )
+        self.offset += sent
+        self.length -= sent
+        
+        done = False
+        if not sent or self.offset >= self.filesize:
+            # Like read, sendfile sends nothing at the end of the file,
+            # but it does so as well if the socket is full. The file may
+            # also have changed its size; it is sent until its end, as
+            # it is when it is read.
+            self.filesize = os.fstat(self.fd.fileno()).st_size
+            done = self.offset >= self.filesize
+        if done:
+            # Leave the file where it would be had it been read.
+            self.fd.seek(self.offset)
+            self.close()
+        return done, sent
+    
     def close(self):
         """ If FileInput is closing, close the fd. """
         Input.close(self)
@@ -270,6 +334,11 @@ class FactoryInput(Input):
 class Collector(object):
     """ This is the base-class for all collectors. Collectors read up to
     nbytes bytes of data from the protocol passed to them. """
+    # Collectors are created in large numbers, e.g. one per field by the
+    # DSL, so the commonly used ones do without an instance dict.
+    # Subclasses that do not define __slots__ get one as usual.
+    __slots__ = ('inited', 'closed', 'onclose')
+    
     def __init__(self, onclose=None):
         self.inited = self.closed = False
         self.onclose = onclose
@@ -320,6 +389,8 @@ class NullCollector(Collector):
 
 class StringCollector(Collector):
     """ Store data received from the socket in a string. """
+    __slots__ = ('intvalue',)
+    
     def __init__(self, onclose=None):
         Collector.__init__(self, onclose)
         
@@ -372,6 +443,8 @@ class FileCollector(Collector):
 class DelimitedCollector(Collector):
     """ Collect up to size bytes in collector and raise CollectorFull
     afterwards. """
+    __slots__ = ('collector', 'size')
+    
     def __init__(self, collector, size, onclose=None):
         Collector.__init__(self, onclose)
         self.collector = collector
@@ -467,6 +540,8 @@ class CollectorQueue(Collector):
     """ Write data to the first collector until CollectorFull is raised,
     afterwards repeat with next. When the CollectorQueue gets empty it
     raises CollectorFull. """
+    __slots__ = ('collectors',)
+    
     def __init__(self, collectors=None, onclose=None):
         Collector.__init__(self, onclose)
         if collectors is None:
@@ -596,16 +671,27 @@ class StructCollector(DelimitedCollector):
     """ Collect and unpack stru. Unpacked value can be found in .value and
     is available upon calling onclose. """
     def __init__(self, stru, onclose=None):
+        # The data is received into a buffer of the size of the struct
+        # rather than concatenated, and unpacked from it in place.
         DelimitedCollector.__init__(
-            self, StringCollector(), stru.size, onclose
+            self, ByteArrayCollector(stru.size), stru.size, onclose
         )
         
         self.stru = stru
         self.intvalue = None
     
     def close(self):
-        """ Unpack the data received and close the collector afterwards. """
-        self.intvalue = self.stru.unpack(self.collector.value)
+        """ Unpack the data received and close the collector afterwards.
+        Raise struct.error if less data than the struct needs has been
+        received. """
+        # The buffer is zero-padded, so unpacking it would not fail.
+        if self.size:
+            raise struct.error(
+                "Got %d of %d bytes of struct." % (
+                    self.stru.size - self.size, self.stru.size
+                )
+            )
+        self.intvalue = self.stru.unpack_from(self.collector.array)
         DelimitedCollector.close(self)
     
     @property
@@ -690,17 +776,41 @@ class MockHandler(object):
         self.outbuf = outbuf
         self.inbuf = inbuf
     
+    def get_inbuf(self):
+        """ Return the data that has not been received yet. """
+        return self._inbuf[self.inpos:]
+    
+    def set_inbuf(self, value):
+        """ Set the data to be received. """
+        self._inbuf = value
+        # Offset of the data not received yet. Advancing it rather
+        # than slicing off what was received saves copying the rest of
+        # inbuf on every recv.
+        self.inpos = 0
+    
+    inbuf = property(get_inbuf, set_inbuf)
+    
+    def get_outbuf(self):
+        """ Return the data that has been sent. """
+        return bytes(self._outbuf)
+    
+    def set_outbuf(self, value):
+        """ Replace the data that has been sent. """
+        # Extending a bytearray is amortised O(1) per byte, whereas
+        # concatenating to a string copies all the data sent so far.
+        self._outbuf = bytearray(value)
+    
+    outbuf = property(get_outbuf, set_outbuf)
+    
     def recv(self, bufsize):
         """ Return up to bufsize bytes from inbuf. Raise ValueError
         when inbuf is empty. """
-        if not self.inbuf:
-            return EMPTY_BYTES
-        i = min(bufsize, len(self.inbuf))
-        data = self.inbuf[:i]
-        self.inbuf = self.inbuf[i:]
+        pos = self.inpos
+        data = self._inbuf[pos:pos + bufsize]
+        self.inpos = pos + len(data)
         return data
     
     def send(self, data):
         """ Write data to outbuf. """
-        self.outbuf += data
+        self._outbuf.extend(data)
         return len(data)
@@ -33,13 +33,19 @@ also assigned to DefaultSocketMap, which otherwise defaults to one
 of the other three.
 """
 
+import os
+import sys
 import select
 import socket
+import struct
 import errno
 import time
+import threading
+
+from thread import get_ident
 
 import asynchia
-from asynchia.util import socketpair, b, EMPTY_BYTES, is_closed
+from asynchia.util import socketpair, EMPTY_BYTES, is_closed
 
 class InterruptContextManager(object):
     """ Allow with socketmap.interrupt() """
@@ -54,90 +60,186 @@ class InterruptContextManager(object):
         self.socket_map.end_interrupt(self.changeflags)
 
 
+# Written to the control fd to wake a socket-map up. An eventfd adds it
+# to its counter as a native 64 bit integer, a socket just receives it.
+_WAKEUP = struct.pack('@Q', 1)
+
+
+def _make_waker():
+    """ Return (controlfd, wakefd, sender, receiver) for the control
+    channel of a socket-map. The socket-map polls controlfd for being
+    readable, wakeups are written to wakefd. Both are non-blocking.
+    
+    On Linux this is a single eventfd and sender and receiver are None.
+    On other POSIX systems it is a pipe, which is cheaper than a
+    socket-pair; sender and receiver are None as well. Elsewhere it is
+    a socket-pair, because select on Windows only works on sockets;
+    sender and receiver are the socket objects that own the fds and
+    have to be kept around. """
+    if hasattr(os, 'eventfd'):
+        fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        return fd, fd, None, None
+    if hasattr(os, 'pipe2'):
+        controlfd, wakefd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        return controlfd, wakefd, None, None
+    if os.name == 'posix':
+        import fcntl
+        controlfd, wakefd = os.pipe()
+        for fd in (controlfd, wakefd):
+            fcntl.fcntl(
+                fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK
+            )
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        return controlfd, wakefd, None, None
+    sender, receiver = socketpair()
+    sender.setblocking(0)
+    receiver.setblocking(0)
+    return receiver.fileno(), sender.fileno(), sender, receiver
+
+
 class ControlSocketSocketMap(asynchia.SocketMap):
-    """ Socket-map with an internal socket-pair that can be used to
-    interrupt it. """
+    """ Socket-map with an internal file-descriptor that can be used to
+    interrupt it. On Linux this is an eventfd, on other POSIX systems a
+    pipe and on Windows a socket-pair. It is only ever used to wake the
+    socket-map up; the thread that interrupts the socket-map and the
+    one polling it are synchronized by threading primitives, which
+    saves a handshake over the channel and the syscalls it costs. """
     def __init__(self, notifier):
         asynchia.SocketMap.__init__(self, notifier)
-        # IMPORTANT! These have to be blocking!
-        self.controlsender, self.controlreceiver = socketpair()
+        (self.controlfd, self.wakefd,
+         self.controlsender, self.controlreceiver) = _make_waker()
+        # Use os.read and os.write on the raw fds rather than the
+        # methods of the socket objects where they work on sockets.
+        self.fdio = os.name == 'posix'
+        # Held while the control channel is used or closed, lest a
+        # thread writes to a fd that has been closed and reused.
+        self.control_lock = threading.Lock()
+        
+        # Only one thread may interrupt the socket-map at a time.
+        self.interrupt_lock = threading.Lock()
+        self.interrupting = False
+        # Set by the socket-map once it has stopped.
+        self.stopped = threading.Event()
+        # Set by the interrupting thread to resume the socket-map.
+        self.resumed = threading.Event()
+        
+        # See _bound_dispatch.
+        self.dispatch_notifier = self.dispatch_table = None
     
     def interrupt(self, changeflags=False):
         """ Return context manager for the interruption of this
         socket-map. """
         return InterruptContextManager(self, changeflags)
     
+    def start_interrupt(self, changeflags=False):
+        """ Stop the socket-map and wait until it is. """
+        self.interrupt_lock.acquire()
+        if self.closed:
+            self.interrupt_lock.release()
+            raise asynchia.SocketMapClosedError
+        self.stopped.clear()
+        self.interrupting = True
+        self.wakeup()
+        self.stopped.wait()
+    
+    def end_interrupt(self, changeflags=False):
+        """ Resume the socket-map stopped by start_interrupt. """
+        self.resumed.set()
+        self.interrupt_lock.release()
+    
     def do_interrupt(self):
-        """ Call this in the socket-map when you have found out that there is
-        data to read on the controlreceiver. """
-        # Read the "s" that started the interrupt
-        recv = self.controlreceiver.recv(1)
-        if recv == b('s'):
-            # Send the "i" that signals the interrupt succeeded.
-            self.controlreceiver.send(b('i'))
-            # Read the "e" that will end the interrupt.
-            self.controlreceiver.recv(1)
-        elif recv == b('b'):
-            return
-        else:
-            raise ValueError
+        """ Call this in the socket-map when you have found out that
+        the controlfd is readable. """
+        self.drain_control()
+        if self.interrupting:
+            self.interrupting = False
+            self.stopped.set()
+            self.resumed.wait()
+            self.resumed.clear()
     
     def wakeup(self):
-        self.controlsender.send(b('b'))
+        """ Wake the socket-map up. Raise SocketMapClosedError if it has
+        been closed. """
+        self.control_lock.acquire()
+        try:
+            if self.wakefd is None:
+                raise asynchia.SocketMapClosedError
+            if self.fdio:
+                os.write(self.wakefd, _WAKEUP)
+            else:
+                self.controlsender.send(_WAKEUP)
+        except (OSError, socket.error), err:
+            # The buffer is full, so the socket-map will wake up
+            # anyway.
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        finally:
+            self.control_lock.release()
+    
+    def drain_control(self):
+        """ Consume the pending wakeups of the controlfd. """
+        self.control_lock.acquire()
+        try:
+            # Nothing is left to drain once the socket-map is closed,
+            # e.g. by a handler in the same poll.
+            if self.controlfd is None:
+                return
+            if self.fdio:
+                os.read(self.controlfd, 4096)
+            else:
+                self.controlreceiver.recv(4096)
+        except (OSError, socket.error), err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        finally:
+            self.control_lock.release()
     
     def close(self):
+        if self.closed:
+            return
         super(ControlSocketSocketMap, self).close()
-        self.controlsender.close()
-        self.controlreceiver.close()
+        # Do not leave a thread waiting for the socket-map to stop
+        # blocked forever.
+        self.stopped.set()
+        self.control_lock.acquire()
+        try:
+            if self.controlsender is None:
+                os.close(self.controlfd)
+                if self.wakefd != self.controlfd:
+                    os.close(self.wakefd)
+            else:
+                self.controlsender.close()
+                self.controlreceiver.close()
+            # The fds may be reused once they are closed, so they must
+            # not be used anymore.
+            self.controlfd = self.wakefd = None
+        finally:
+            self.control_lock.release()
 
 
 class FragileSocketMap(ControlSocketSocketMap):
     """ The socket-map has to be interrupted before internals are
     changed. """
-    def start_interrupt(self, changeflags=False):
-        """ See SocketMap.start_interrupt. """
-        self.controlsender.send(b('s'))
-        self.controlsender.recv(1)
-    
-    def end_interrupt(self, changeflags=False):
-        """ See SocketMap.end_interrupt. """
-        self.controlsender.send(b('e'))
+    pass
 
 
 class RobustSocketMap(ControlSocketSocketMap):
     """ The socket-map has to be stopped and resumed after internals
     are changed. """
-    def __init__(self, notifier=None):
-        ControlSocketSocketMap.__init__(self, notifier)
-        self.needresp = False
-    
     def start_interrupt(self, changeflags=False):
         """ See SocketMap.start_interrupt. """
         if not changeflags:
-            # Same as FragileSocketMap.start_interrupt.
-            self.controlsender.send(b('s'))
-            self.controlsender.recv(1)
-        else:
-            self.needresp = True
+            ControlSocketSocketMap.start_interrupt(self)
     
     def end_interrupt(self, changeflags=False):
         """ See SocketMap.end_interrupt. """
-        if not changeflags:
-            # Same as FragileSocketMap.end_interrupt.
-            self.controlsender.send(b('e'))
+        if changeflags:
+            # The changes are picked up as soon as the socket-map polls
+            # again, so there is no need to wait for it to stop.
+            self.wakeup()
         else:
-            self.controlsender.send(b('s'))
-            self.controlsender.recv(1)
-            self.controlsender.send(b('e'))
-    
-    def close(self):
-        """ Signal the interrupt is finished to any thread that may be
-        waiting, as the program, waiting for the thread to finish,
-        would not be able to exit otherwise. """
-        if self.needresp:
-            self.controlreceiver.send(b('i'))
-            self.needresp = False
-        super(RobustSocketMap, self).close()
+            ControlSocketSocketMap.end_interrupt(self)
 
 
 class RockSolidSocketMap(ControlSocketSocketMap):
@@ -146,15 +248,163 @@ class RockSolidSocketMap(ControlSocketSocketMap):
     def start_interrupt(self, changeflags=False):
         """ See SocketMap.start_interrupt. """
         if not changeflags:
-            # Same as FragileSocketMap.start_interrupt.
-            self.controlsender.send(b('s'))
-            self.controlsender.recv(1)
+            ControlSocketSocketMap.start_interrupt(self)
     
     def end_interrupt(self, changeflags=False):
         """ See SocketMap.end_interrupt. """
         if not changeflags:
-            # Same as FragileSocketMap.end_interrupt.
-            self.controlsender.send(b('e'))
+            ControlSocketSocketMap.end_interrupt(self)
+
+
+# Indices into the tuple returned by _notifier_actions.
+_READ, _WRITE, _EXCEPT, _CLOSE, _PROBE = range(5)
+
+
+def _notifier_actions(notifier):
+    """ Return the functions that notify a handler about being readable,
+    writeable, in exceptional state and closed, and a variant of the
+    first that probes whether the connection was closed before, in
+    this order.
+    
+    A connection closed by the other end is only reported as readable
+    by select.select, and by poll unless it supports POLLRDHUP. Reading
+    from it is thus reported as closing it if probing the socket shows
+    that there is no data left. """
+    read_obj = notifier.read_obj
+    close_obj = notifier.close_obj
+    
+    def probe(obj):
+        if obj.connected and obj.is_closed():
+            close_obj(obj)
+        else:
+            read_obj(obj)
+    
+    return (
+        read_obj, notifier.write_obj, notifier.except_obj, close_obj, probe
+    )
+
+
+def _bound_dispatch(socket_map, table):
+    """ Return table with the action indices replaced by the functions
+    returned by _notifier_actions for the notifier of socket_map, so
+    that dispatching an event is a single lookup followed by calls.
+    The result is cached on the socket-map until its notifier is
+    replaced. """
+    notifier = socket_map.notifier
+    if socket_map.dispatch_notifier is not notifier:
+        actions = _notifier_actions(notifier)
+        socket_map.dispatch_table = dict(
+            (key, tuple(actions[action] for action in row))
+            for key, row in table.iteritems()
+        )
+        socket_map.dispatch_notifier = notifier
+    return socket_map.dispatch_table
+
+
+def _build_dispatch(mask, bits):
+    """ Return a dict mapping every combination of the bits in mask to
+    the actions to take for it. bits is a list of (bits, action) pairs,
+    the actions are taken in that order if any of their bits is set. """
+    table = {}
+    flags = mask
+    # Enumerate all subsets of mask.
+    while True:
+        table[flags] = tuple(
+            action for bit, action in bits if flags & bit
+        )
+        if not flags:
+            return table
+        flags = (flags - 1) & mask
+
+
+# Bits SelectSocketMap.poll uses to merge the lists returned by
+# select.select, and the actions to take for every combination of them.
+# select.select cannot tell a closed connection from a readable one.
+_SELECT_READ, _SELECT_WRITE, _SELECT_EXCEPT = 1, 2, 4
+_SELECT_DISPATCH = _build_dispatch(
+    _SELECT_READ | _SELECT_WRITE | _SELECT_EXCEPT,
+    [(_SELECT_READ, _PROBE), (_SELECT_WRITE, _WRITE),
+     (_SELECT_EXCEPT, _EXCEPT)]
+)
+
+# The fd_sets of select.select cannot hold more than FD_SETSIZE sockets.
+# On Windows this limits their number, elsewhere the value of their
+# filenos. Not exposed by the select module.
+_FD_SETSIZE = getattr(select, 'FD_SETSIZE', 512 if os.name == 'nt' else 1024)
+
+# Set by poll and epoll (they share the value) on Linux if the other end
+# has shut the connection down. Not exposed by the select module of
+# Python 2.
+_POLLRDHUP = getattr(select, 'POLLRDHUP', 0)
+
+# Used by EPollSocketMap. Not exposed by the socket module, so fall back
+# to the value of asm-generic/socket.h on Linux.
+_SO_BUSY_POLL = getattr(
+    socket, 'SO_BUSY_POLL', 46 if sys.platform.startswith('linux') else None
+)
+
+
+def _build_poll_dispatch():
+    """ Return (mask, table) where table[flags & mask] is the tuple of
+    actions _dispatch_poll needs to take for an fd that select.poll or
+    select.epoll reported with flags, in the order read, write, except,
+    close. The flags of poll and epoll have the same values. """
+    if not hasattr(select, 'poll'):
+        return 0, {0: ()}
+    pollin = select.POLLIN
+    pollout = select.POLLOUT
+    pollpri = select.POLLPRI
+    pollclose = select.POLLHUP | select.POLLERR | select.POLLNVAL
+    
+    mask = pollin | pollout | pollpri | pollclose | _POLLRDHUP
+    # Out-of-band data only sets POLLPRI and is delivered to except_obj
+    # alone; reporting it as readable as well would make the handler
+    # recv with no normal data available.
+    bits = [(pollin, _PROBE), (pollout, _WRITE), (pollpri, _EXCEPT),
+            (pollclose, _CLOSE)]
+    table = _build_dispatch(mask, bits)
+    if _POLLRDHUP:
+        # A closed connection is reported with POLLRDHUP, so the
+        # socket only needs to be probed if that is set.
+        for flags, actions in table.iteritems():
+            if flags & pollin and not flags & _POLLRDHUP:
+                table[flags] = (_READ, ) + actions[1:]
+    return mask, table
+
+
+_POLL_MASK, _POLL_DISPATCH = _build_poll_dispatch()
+
+
+def _dispatch_poll(active, socket_list, controlfd, table,
+                   _mask=_POLL_MASK):
+    """ Pass the (fileno, flags) pairs returned by select.poll or
+    select.epoll on to the notifier, looking the handlers up in
+    socket_list, which is indexed by fileno. table is _POLL_DISPATCH
+    bound to the notifier by _bound_dispatch. Return whether the
+    controlfd was among them, i.e. whether the socket-map has been
+    interrupted.
+    
+    This is the innermost loop of PollSocketMap and EPollSocketMap, so
+    everything it needs is bound to locals before entering it and the
+    flags are decoded by a single lookup in the table. """
+    interrupted = False
+    for fileno, flags in active:
+        try:
+            obj = socket_list[fileno]
+        # MacOS seems to give us invalid fds and thus we need to do
+        # this sanity check.
+        except IndexError:
+            obj = None
+        if obj is None:
+            # The controlfd never has a handler, so it is only looked
+            # for among the filenos that have none instead of comparing
+            # every fileno to it.
+            if fileno == controlfd:
+                interrupted = True
+            continue
+        for action in table[flags & _mask]:
+            action(obj)
+    return interrupted
 
 
 class SelectSocketMap(FragileSocketMap):
@@ -163,10 +413,17 @@ class SelectSocketMap(FragileSocketMap):
     
     def __init__(self, notifier=None):
         FragileSocketMap.__init__(self, notifier)
-        self.writers = set()
         self.socket_list = set()
+        self._count = 0
         
-        self.socket_list.add(self.controlreceiver)
+        # select.select is passed filenos rather than the handlers so it
+        # does not need to call their fileno methods on every poll.
+        self.fd_to_handler = {}
+        self.read_fds = set([self.controlfd])
+        self.write_fds = set()
+        # select.select copies the sets into lists on every call, so
+        # the lists are kept and only rebuilt after the sets changed.
+        self.read_list = self.write_list = None
         
         self.constructed()
     
@@ -174,7 +431,21 @@ class SelectSocketMap(FragileSocketMap):
         """ See SocketMap.add_transport. """
         if handler in self.socket_list:
             raise ValueError("Handler %r already in socket map!" % handler)
+        fileno = handler.fileno()
+        if os.name == 'nt':
+            # The control channel takes up one slot.
+            full = self._count + 1 >= _FD_SETSIZE
+        else:
+            full = fileno >= _FD_SETSIZE
+        if full:
+            raise asynchia.SocketMapFullError(
+                "Cannot add %r to a select socket map." % handler
+            )
         self.socket_list.add(handler)
+        self.fd_to_handler[fileno] = handler
+        self.read_fds.add(fileno)
+        self.read_list = None
+        self._count += 1
         if handler.readable:
             self.add_reader(handler)
         if handler.writeable:
@@ -182,22 +453,28 @@ class SelectSocketMap(FragileSocketMap):
     
     def del_transport(self, handler):
         """ See SocketMap.del_transport. """
+        fileno = handler.fileno()
         self.socket_list.remove(handler)
+        del self.fd_to_handler[fileno]
+        self.read_fds.remove(fileno)
+        self.read_list = None
+        self._count -= 1
         if handler.readable:
             self.del_reader(handler)
-        if handler.writeable:
-            self.del_writer(handler)
-        if handler.awaiting_connect:
+        # A handler that is writeable while awaiting its connect is
+        # only in the writers once.
+        if handler.writeable or handler.awaiting_connect:
             self.del_writer(handler)
-        pass
     
     def add_writer(self, handler):
         """ See SocketMap.add_writer. """
-        self.writers.add(handler)
+        self.write_fds.add(handler.fileno())
+        self.write_list = None
     
     def del_writer(self, handler):
         """ See SocketMap.del_writer. """
-        self.writers.remove(handler)
+        self.write_fds.remove(handler.fileno())
+        self.write_list = None
     
     def add_reader(self, handler):
         """ See SocketMap.add_reader. """
@@ -214,32 +491,40 @@ class SelectSocketMap(FragileSocketMap):
         
         timeout = self._get_timeout(otimeout)
         
-        interrupted = False
+        read_list = self.read_list
+        if read_list is None:
+            read_list = self.read_list = list(self.read_fds)
+        write_list = self.write_list
+        if write_list is None:
+            write_list = self.write_list = list(self.write_fds)
         
         try:
-            read, write, expt = select.select(self.socket_list,
-                                              self.writers,
-                                              self.socket_list, timeout)
+            read, write, expt = select.select(read_list, write_list,
+                                              read_list, timeout)
         except IOError, err:
             if err.args[0] == errno.EINTR:
                 return
             else:
                 raise
-
-        for obj in read:
-            if obj != self.controlreceiver:
-                # This seems to be the only way to find hangup-events with
-                # select.
-                if obj.connected and obj.is_closed():
-                    self.notifier.close_obj(obj)
-                else:
-                    self.notifier.read_obj(obj)
-            else:
-                interrupted = True
-        for obj in write:
-            self.notifier.write_obj(obj)
-        for obj in expt:
-            self.notifier.except_obj(obj)
+        
+        # Merge the three lists so every handler is only looked up and
+        # dispatched once, like with the other socket-maps.
+        events = dict.fromkeys(read, _SELECT_READ)
+        for fileno in write:
+            events[fileno] = events.get(fileno, 0) | _SELECT_WRITE
+        for fileno in expt:
+            events[fileno] = events.get(fileno, 0) | _SELECT_EXCEPT
+        interrupted = events.pop(self.controlfd, None) is not None
+        
+        get_handler = self.fd_to_handler.get
+        table = _bound_dispatch(self, _SELECT_DISPATCH)
+        for fileno, mask in events.iteritems():
+            # The handler may have been removed by one that came before.
+            obj = get_handler(fileno)
+            if obj is None:
+                continue
+            for action in table[mask]:
+                action(obj)
         
         if interrupted:
             self.do_interrupt()
@@ -248,16 +533,20 @@ class SelectSocketMap(FragileSocketMap):
     
     def close(self):
         """ See SocketMap.close """
-        for handler in self.socket_list ^ set([self.controlreceiver]):
+        for handler in self.socket_list:
             self.notifier.cleanup_obj(handler)
         
-        self.writers = set()
         self.socket_list = set()
+        self.fd_to_handler = {}
+        self.read_fds = set([self.controlfd])
+        self.write_fds = set()
+        self.read_list = self.write_list = None
+        self._count = 0
         
         super(SelectSocketMap, self).close()
     
     def is_empty(self):
-        return not bool(self.socket_list)
+        return self._count == 0
 
 
 class PollSocketMap(RobustSocketMap):
@@ -270,12 +559,35 @@ class PollSocketMap(RobustSocketMap):
     """
     available = hasattr(select, 'poll')
     
+    # The flags of a handler only depend on whether it wants to write,
+    # so both possible values are computed once.
+    if available:
+        _FLAGS_RO = (
+            select.POLLERR | select.POLLHUP | select.POLLNVAL |
+            select.POLLIN | select.POLLPRI | _POLLRDHUP
+        )
+        _FLAGS_RW = _FLAGS_RO | select.POLLOUT
+    else:
+        _FLAGS_RO = _FLAGS_RW = None
+    
     def __init__(self, notifier=None):
         RobustSocketMap.__init__(self, notifier)
-        self.socket_list = {}
+        # Handlers indexed by their fileno. As filenos are small
+        # integers, a list with None for the unused ones is cheaper
+        # to look them up in than a dict.
+        self.socket_list = []
+        # Flags each fileno is currently registered with. Other threads
+        # may change them while the socket-map is polling, so the lock
+        # is held while they are compared, passed on and stored.
+        self.flags = {}
+        self.flags_lock = threading.Lock()
+        self._count = 0
+        # Handlers changed by the thread polling the socket-map whose
+        # flags still have to be passed on to the poller.
+        self.dirty = set()
+        self.poll_thread = None
         self.poller = select.poll()
         
-        self.controlfd = self.controlreceiver.fileno()
         self.poller.register(self.controlfd, select.POLLIN | select.POLLPRI)
         
         self.constructed()
@@ -283,25 +595,46 @@ class PollSocketMap(RobustSocketMap):
     def add_transport(self, handler):
         """ See SocketMap.add_transport. """
         fileno = handler.fileno()
-        if fileno in self.socket_list:
+        socket_list = self.socket_list
+        if fileno >= len(socket_list):
+            socket_list.extend([None] * (fileno + 1 - len(socket_list)))
+        elif socket_list[fileno] is not None:
             raise ValueError("Socket with fileno %d already "
                              "in socket map!" % fileno)
-        self.socket_list[fileno] = handler
-        self.poller.register(fileno, self.create_flags(handler))
+        socket_list[fileno] = handler
+        self._count += 1
+        flags = self.create_flags(handler)
+        self.flags_lock.acquire()
+        try:
+            self.poller.register(fileno, flags)
+            self.flags[fileno] = flags
+        finally:
+            self.flags_lock.release()
     
     def del_transport(self, handler):
         """ See SocketMap.del_transport. """
         fileno = handler.fileno()
-        del self.socket_list[fileno]
-        self.poller.unregister(fileno)
+        socket_list = self.socket_list
+        socket_list[fileno] = None
+        # Drop the unused slots at the end so the list stays as short
+        # as the highest fileno in use requires.
+        while socket_list and socket_list[-1] is None:
+            socket_list.pop()
+        self.dirty.discard(handler)
+        self._count -= 1
+        self.flags_lock.acquire()
+        try:
+            del self.flags[fileno]
+            self.poller.unregister(fileno)
+        finally:
+            self.flags_lock.release()
     
     def poll(self, timeout):
         """ Poll for I/O. """
         if self.closed:
             raise asynchia.SocketMapClosedError
         
-        interrupted = False
-        
+        self.poll_thread = get_ident()
         timeout = self._get_timeout(timeout)
         
         # Stupidest API ever. epoll accepts a float in seconds whereas
@@ -309,6 +642,9 @@ class PollSocketMap(RobustSocketMap):
         if timeout is not None:
             timeout = int(timeout * 1000)
         
+        if self.dirty:
+            self.flush_dirty()
+        
         try:
             active = self.poller.poll(timeout)
         except IOError, err:
@@ -317,65 +653,90 @@ class PollSocketMap(RobustSocketMap):
             else:
                 raise
         
-        for fileno, flags in active:
-            if fileno == self.controlfd:
-                interrupted = True
-                continue
-            try:
-                obj = self.socket_list[fileno]
-            # MacOS seems to give us invalid fds and thus we need to do
-            # this sanity check.
-            except KeyError:
-                continue
-            if flags & (select.POLLIN | select.POLLPRI):
-                if obj.connected and obj.is_closed():
-                    self.notifier.close_obj(obj)
-                else:
-                    self.notifier.read_obj(obj)
-            if flags & select.POLLOUT:
-                self.notifier.write_obj(obj)
-            if flags & select.POLLPRI:
-                self.notifier.except_obj(obj)
-            if flags & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
-                self.notifier.close_obj(obj)
+        interrupted = _dispatch_poll(
+            active, self.socket_list, self.controlfd,
+            _bound_dispatch(self, _POLL_DISPATCH)
+        )
         if interrupted:
             self.do_interrupt()
         self._run_timers()
     
     def handler_changed(self, handler):
-        """ Update flags for handler. """
-        # self.poller.register is compatible to 2.5 whilst
-        # self.poller.modify is not.
-        self.poller.register(handler.fileno(), self.create_flags(handler))
+        """ Update flags for handler. Changes made by the thread polling
+        the socket-map, i.e. by the handlers themselves, are deferred
+        until it polls again, so a handler that changes its state
+        several times in between costs one syscall at most. """
+        if get_ident() == self.poll_thread:
+            self.dirty.add(handler)
+        else:
+            self.update_flags(handler)
+    
+    def update_flags(self, handler):
+        """ Pass the current flags of handler on to the poller. """
+        fileno = handler.fileno()
+        self.flags_lock.acquire()
+        try:
+            current = self.flags.get(fileno)
+            # The handler has been removed meanwhile.
+            if current is None:
+                return
+            # The flags are only computed once the lock is held, so the
+            # last update passes on the latest state of the handler.
+            flags = self.create_flags(handler)
+            # Most changes, e.g. all of those to readability, do not
+            # change the flags, so there is no need to tell the poller
+            # about them.
+            if flags != current:
+                # self.poller.register is compatible to 2.5 whilst
+                # self.poller.modify is not.
+                self.poller.register(fileno, flags)
+                self.flags[fileno] = flags
+        finally:
+            self.flags_lock.release()
+    
+    def flush_dirty(self):
+        """ Apply the changes deferred by handler_changed. """
+        dirty = self.dirty
+        self.dirty = set()
+        for handler in dirty:
+            self.update_flags(handler)
+    
+    # Only whether the handler wants to write is reflected in its flags
+    # (see create_flags), so changes to whether it wants to read need
+    # not even be looked at.
+    add_writer = del_writer = handler_changed
+    
+    def add_reader(self, handler):
+        """ See SocketMap.add_reader. """
+        pass
     
-    # We just update the flags of the object, doesn't matter what has
-    # changed.
-    add_writer = del_writer = add_reader = del_reader = handler_changed
+    def del_reader(self, handler):
+        """ See SocketMap.del_reader. """
+        pass
     
     @staticmethod
-    def create_flags(handler):
+    def create_flags(handler, _ro=_FLAGS_RO, _rw=_FLAGS_RW):
         """ Generate appropriate flags for handler. These flags will
         represent the current state of the handler (if it is readable,
         the flags say so too). """
-        flags = (
-            select.POLLERR | select.POLLHUP | select.POLLNVAL |
-            select.POLLIN | select.POLLPRI
-        )
         if handler.writeable or handler.awaiting_connect:
-            flags |= select.POLLOUT
-        return flags
+            return _rw
+        return _ro
     
     def close(self):
         """ See SocketMap.close """
-        RobustSocketMap.close(self)
-        for handler in self.socket_list.itervalues():
-            self.notifier.cleanup_obj(handler)
-        self.socket_list = {}
+        for handler in self.socket_list:
+            if handler is not None:
+                self.notifier.cleanup_obj(handler)
+        self.socket_list = []
+        self.flags = {}
+        self.dirty = set()
+        self._count = 0
         
         super(PollSocketMap, self).close()
     
     def is_empty(self):
-        return not bool(self.socket_list)
+        return self._count == 0
 
 
 class EPollSocketMap(RockSolidSocketMap):
@@ -385,15 +746,65 @@ class EPollSocketMap(RockSolidSocketMap):
     functionality is available on your operation system by checking
     the `available` class-member, it may not exist on some platforms
     (it is known not to on Windows and BSD).
+    
+    If edge_triggered is True, every transport is registered once for
+    all events with EPOLLET set (Linux >= 2.6), and
+    add_reader/del_reader/add_writer/del_writer stop issuing an
+    epoll_ctl syscall for every state change. An edge is only reported
+    once, so the sockets must be nonblocking and handlers have to drain
+    them until EAGAIN (e.g. accept or recv in a loop until
+    socket.error with EWOULDBLOCK) or they will not be notified about
+    the data that is left. The only syscall left is a re-arm in
+    add_reader and add_writer, so that an edge that was consumed while
+    the handler was not interested in it is reported again.
+    
+    sizehint is passed on to select.epoll; if the number of sockets the
+    socket-map is going to hold is known, it can be used to size the
+    internal data structures of the kernel in advance.
+    
+    If busy_poll is given, SO_BUSY_POLL is set to it (in microseconds)
+    on every socket added, which makes the kernel busy-poll the device
+    queue for that long on a blocking read before sleeping (Linux >=
+    3.11, needs CAP_NET_ADMIN to raise it above the
+    net.core.busy_read sysctl). This lowers the latency of receiving
+    at the cost of CPU time. It has no effect on loopback, and it is
+    silently ignored where it is not supported.
     """
     available = hasattr(select, 'epoll')
     
-    def __init__(self, notifier=None):
+    # See PollSocketMap.
+    if available:
+        _FLAGS_RO = (
+            select.EPOLLERR | select.EPOLLHUP | select.POLLNVAL |
+            select.EPOLLIN | select.EPOLLPRI | _POLLRDHUP
+        )
+        _FLAGS_RW = _FLAGS_RO | select.EPOLLOUT
+        _FLAGS_ET = _FLAGS_RW | select.EPOLLET
+    else:
+        _FLAGS_RO = _FLAGS_RW = _FLAGS_ET = None
+    
+    def __init__(self, notifier=None, edge_triggered=False, sizehint=-1,
+                 busy_poll=0):
         RockSolidSocketMap.__init__(self, notifier)
-        self.socket_list = {}
-        self.poller = select.epoll()
+        self.edge_triggered = edge_triggered
+        self.busy_poll = busy_poll if _SO_BUSY_POLL is not None else 0
+        if edge_triggered:
+            self.create_flags = self._create_flags_et
+            self.add_reader = self.add_writer = self._rearm
+            self.del_reader = self.del_writer = self._noop
+        # See PollSocketMap.
+        self.socket_list = []
+        # Flags each fileno is currently registered with. Other threads
+        # may change them while the socket-map is polling, so the lock
+        # is held while they are compared, passed on and stored.
+        self.flags = {}
+        self.flags_lock = threading.Lock()
+        self._count = 0
+        # See PollSocketMap.
+        self.dirty = set()
+        self.poll_thread = None
+        self.poller = select.epoll(sizehint)
         
-        self.controlfd = self.controlreceiver.fileno()
         self.poller.register(self.controlfd, select.EPOLLIN | select.EPOLLPRI)
         
         self.constructed()
@@ -401,24 +812,57 @@ class EPollSocketMap(RockSolidSocketMap):
     def add_transport(self, handler):
         """ See SocketMap.add_transport. """
         fileno = handler.fileno()
-        if fileno in self.socket_list:
+        socket_list = self.socket_list
+        if fileno >= len(socket_list):
+            socket_list.extend([None] * (fileno + 1 - len(socket_list)))
+        elif socket_list[fileno] is not None:
             raise ValueError("Socket with fileno %d already "
                              "in socket map!" % fileno)
-        self.socket_list[fileno] = handler
-        self.poller.register(fileno, self.create_flags(handler))
+        socket_list[fileno] = handler
+        self._count += 1
+        flags = self.create_flags(handler)
+        self.flags_lock.acquire()
+        try:
+            self.poller.register(fileno, flags)
+            self.flags[fileno] = flags
+        finally:
+            self.flags_lock.release()
+        if self.busy_poll:
+            self._set_busy_poll(handler)
+    
+    def _set_busy_poll(self, handler):
+        """ Set SO_BUSY_POLL on the socket of handler. """
+        try:
+            handler.socket.setsockopt(
+                socket.SOL_SOCKET, _SO_BUSY_POLL, self.busy_poll
+            )
+        except (socket.error, AttributeError):
+            # Not a socket (e.g. no SocketTransport) or not permitted.
+            pass
     
     def del_transport(self, handler):
         """ See SocketMap.del_transport. """
         fileno = handler.fileno()
-        del self.socket_list[fileno]
-        self.poller.unregister(fileno)
+        socket_list = self.socket_list
+        socket_list[fileno] = None
+        # See PollSocketMap.del_transport.
+        while socket_list and socket_list[-1] is None:
+            socket_list.pop()
+        self.dirty.discard(handler)
+        self._count -= 1
+        self.flags_lock.acquire()
+        try:
+            del self.flags[fileno]
+            self.poller.unregister(fileno)
+        finally:
+            self.flags_lock.release()
     
     def poll(self, timeout):
         """ Poll for I/O. """
         if self.closed:
             raise asynchia.SocketMapClosedError
         
-        
+        self.poll_thread = get_ident()
         timeout = self._get_timeout(timeout)
         
         # While select.poll is alright with None, select.epoll expects
@@ -426,66 +870,112 @@ class EPollSocketMap(RockSolidSocketMap):
         if timeout is None:
             timeout = -1
         
-        interrupted = False
+        if self.dirty:
+            self.flush_dirty()
         
         try:
-            active = self.poller.poll(timeout)
+            # select.epoll allocates room for maxevents events on every
+            # call, which defaults to FD_SETSIZE - 1. No more than one
+            # per registered fd can be returned.
+            active = self.poller.poll(timeout, self._count + 1)
         except IOError, err:
             if err.args[0] == errno.EINTR:
                 return
             else:
                 raise
         
-        for fileno, flags in active:
-            if fileno == self.controlfd:
-                interrupted = True
-                continue
-            obj = self.socket_list[fileno]
-            if flags & (select.EPOLLIN | select.EPOLLPRI):
-                if obj.connected and obj.is_closed():
-                    self.notifier.close_obj(obj)
-                else:
-                    self.notifier.read_obj(obj)
-            if flags & select.EPOLLOUT:
-                self.notifier.write_obj(obj)
-            if flags & select.EPOLLPRI:
-                self.notifier.except_obj(obj)
-            if flags & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
-                self.notifier.close_obj(obj)
+        interrupted = _dispatch_poll(
+            active, self.socket_list, self.controlfd,
+            _bound_dispatch(self, _POLL_DISPATCH)
+        )
         if interrupted:
             self.do_interrupt()
         self._run_timers()
     
     def handler_changed(self, handler):
-        """ Update flags for handler. """
-        self.poller.modify(handler.fileno(), self.create_flags(handler))
+        """ Update flags for handler. See PollSocketMap.handler_changed;
+        changes made by other threads take effect immediately, even
+        while the socket-map is polling. """
+        if get_ident() == self.poll_thread:
+            self.dirty.add(handler)
+        else:
+            self.update_flags(handler)
+    
+    def update_flags(self, handler):
+        """ Pass the current flags of handler on to the poller. """
+        fileno = handler.fileno()
+        # See PollSocketMap.update_flags.
+        self.flags_lock.acquire()
+        try:
+            current = self.flags.get(fileno)
+            if current is None:
+                return
+            flags = self.create_flags(handler)
+            if flags != current:
+                self.poller.modify(fileno, flags)
+                self.flags[fileno] = flags
+        finally:
+            self.flags_lock.release()
+    
+    def flush_dirty(self):
+        """ Apply the changes deferred by handler_changed. """
+        dirty = self.dirty
+        self.dirty = set()
+        for handler in dirty:
+            self.update_flags(handler)
+    
+    # See PollSocketMap.
+    add_writer = del_writer = handler_changed
+    
+    def add_reader(self, handler):
+        """ See SocketMap.add_reader. """
+        pass
     
-    # We just update the flags of the object, doesn't matter what has
-    # changed.
-    add_writer = del_writer = add_reader = del_reader = handler_changed
+    def del_reader(self, handler):
+        """ See SocketMap.del_reader. """
+        pass
     
     @staticmethod
-    def create_flags(handler):
+    def create_flags(handler, _ro=_FLAGS_RO, _rw=_FLAGS_RW):
         """ Generate appropriate flags for handler. These flags will
         represent the current state of the handler (if it is readable,
         the flags say so too). """
-        flags = (
-            select.EPOLLERR | select.EPOLLHUP | select.POLLNVAL |
-            select.EPOLLIN | select.EPOLLPRI
-        )
         if handler.writeable or handler.awaiting_connect:
-            flags |= select.EPOLLOUT
-        return flags
+            return _rw
+        return _ro
+    
+    @staticmethod
+    def _create_flags_et(handler, _et=_FLAGS_ET):
+        """ Edge-triggered transports are always registered for all
+        events; the notifier ignores the ones they are not interested
+        in. """
+        return _et
+    
+    def _rearm(self, handler):
+        """ Re-register handler so that it is notified about an edge
+        it may have missed while it was not interested in it. """
+        self.poller.modify(handler.fileno(), self._FLAGS_ET)
+    
+    @staticmethod
+    def _noop(handler):
+        """ Edge-triggered transports need not be updated when they
+        lose interest in an event. """
+        pass
     
     def close(self):
         """ See SocketMap.close """
-        for handler in self.socket_list.itervalues():
-            self.notifier.cleanup_obj(handler)
+        for handler in self.socket_list:
+            if handler is not None:
+                self.notifier.cleanup_obj(handler)
+        self.socket_list = []
+        self.flags = {}
+        self.dirty = set()
+        self._count = 0
         self.poller.close()
         super(EPollSocketMap, self).close()
     
     def is_empty(self):
-        return not bool(self.socket_list)
+        return self._count == 0
 
 
 # It is possible to only get hangup events by applying the hack presented
@@ -503,17 +993,28 @@ class KQueueSocketMap(RockSolidSocketMap):
     functionality is available on your operation system by checking
     the `available` class-member, it may not exist on some platforms
     (it only exists on BSD).
+    
+    nevents is the maximum number of events a single poll reports.
+    Events beyond it are left for the next poll, which costs another
+    kevent syscall; room for all of them is allocated on every poll, so
+    it should not be much larger than the number of sockets expected to
+    be ready at once.
     """
     available = hasattr(select, 'kqueue')
     
-    def __init__(self, nevents=100, notifier=None):
+    def __init__(self, nevents=1024, notifier=None):
         RockSolidSocketMap.__init__(self, notifier)
         self.socket_list = {}
+        self._count = 0
         self.queue = select.kqueue()
         
         self.nevents = nevents
+        # kevents changed by the thread polling the socket-map, passed
+        # to the kqueue along with the next poll. See
+        # PollSocketMap.handler_changed.
+        self.changes = []
+        self.poll_thread = None
         
-        self.controlfd = self.controlreceiver.fileno()
         self.queue.control(
             [select.kevent(self.controlfd,
                            select.KQ_FILTER_READ,
@@ -522,16 +1023,26 @@ class KQueueSocketMap(RockSolidSocketMap):
         
         self.constructed()
     
+    def change(self, handler, filter_, flags):
+        """ Change the kevent of handler for filter_. Changes made by
+        the thread polling the socket-map are deferred until it polls
+        again, those of other threads take effect immediately. """
+        kevent = select.kevent(handler.fileno(), filter_, flags)
+        if get_ident() == self.poll_thread:
+            self.changes.append(kevent)
+        else:
+            self.queue.control([kevent], 0)
+    
     def add_transport(self, handler):
         """ See SocketMap.add_transport. """
-        if handler in self.socket_list:
-            raise ValueError("Handler %r already in socket map!" % handler)
-        self.socket_list[handler.fileno()] = handler
+        fileno = handler.fileno()
+        if fileno in self.socket_list:
+            raise ValueError("Socket with fileno %d already "
+                             "in socket map!" % fileno)
+        self.socket_list[fileno] = handler
+        self._count += 1
         
-        self.queue.control(
-            [select.kevent(handler, select.KQ_FILTER_READ, select.KQ_EV_ADD)],
-            0
-        )
+        self.change(handler, select.KQ_FILTER_READ, select.KQ_EV_ADD)
         
         if handler.readable:
             self.add_reader(handler)
@@ -540,19 +1051,39 @@ class KQueueSocketMap(RockSolidSocketMap):
     
     def del_transport(self, handler):
         """ See SocketMap.del_transport. """
-        self.socket_list.pop(handler.fileno())
+        fileno = handler.fileno()
+        self.socket_list.pop(fileno)
+        self._count -= 1
         
-        self.queue.control(
-            [select.kevent(
-                handler, select.KQ_FILTER_READ, select.KQ_EV_DELETE)
-             ],
-            0
-        )
+        # The socket is about to be closed, which would make the
+        # changes deferred for it fail, and its fileno may be reused by
+        # a socket added before the next poll, so they are dropped. The
+        # filters they would have changed are deleted right away.
+        write = handler.writeable or handler.awaiting_connect
+        if self.changes:
+            changes = []
+            for kevent in self.changes:
+                if kevent.ident != fileno:
+                    changes.append(kevent)
+                elif kevent.filter == select.KQ_FILTER_WRITE:
+                    write = True
+            self.changes = changes
         
-        if handler.readable:
-            self.del_reader(handler)
-        if handler.writeable or handler.awaiting_connect:
-            self.del_writer(handler)
+        filters = [select.KQ_FILTER_READ]
+        if write:
+            filters.append(select.KQ_FILTER_WRITE)
+        # One at a time, so that a failing one does not keep the other
+        # from being deleted.
+        for filter_ in filters:
+            try:
+                self.queue.control(
+                    [select.kevent(fileno, filter_, select.KQ_EV_DELETE)], 0
+                )
+            except (OSError, IOError), err:
+                # The change adding the filter was dropped before it
+                # was applied.
+                if err.args[0] != errno.ENOENT:
+                    raise
     
     def add_reader(self, handler):
         """ See SocketMap.add_reader. """
@@ -564,57 +1095,80 @@ class KQueueSocketMap(RockSolidSocketMap):
     
     def add_writer(self, handler):
         """ See SocketMap.add_writer. """
-        self.queue.control(
-            [select.kevent(handler, select.KQ_FILTER_WRITE, select.KQ_EV_ADD)],
-            0
-        )
+        self.change(handler, select.KQ_FILTER_WRITE, select.KQ_EV_ADD)
     
     def del_writer(self, handler):
         """ See SocketMap.del_writer. """
-        self.queue.control(
-            [select.kevent(
-                handler, select.KQ_FILTER_WRITE, select.KQ_EV_DELETE)
-             ],
-            0
-        )
+        self.change(handler, select.KQ_FILTER_WRITE, select.KQ_EV_DELETE)
     
     def poll(self, timeout=None):
+        """ Poll for I/O. """
         if self.closed:
             raise asynchia.SocketMapClosedError
         
+        self.poll_thread = get_ident()
+        timeout = self._get_timeout(timeout)
         interrupted = False
         
+        changes = self.changes
+        if changes:
+            self.changes = []
+            # Make room for an error being reported for every change.
+            nevents = max(self.nevents, len(changes))
+        else:
+            changes = None
+            nevents = self.nevents
+        
         try:
-            res = self.queue.control(None, self.nevents, timeout)
+            res = self.queue.control(changes, nevents, timeout)
         except IOError, err:
             if err.args[0] == errno.EINTR:
                 return
             else:
                 raise
         
+        # Bind everything used per event to locals.
+        controlfd = self.controlfd
+        get_handler = self.socket_list.get
+        # Every kevent is reported for one filter only.
+        dispatch = {
+            select.KQ_FILTER_READ: self.notifier.read_obj,
+            select.KQ_FILTER_WRITE: self.notifier.write_obj,
+        }
+        close_obj = self.notifier.close_obj
+        ev_eof = select.KQ_EV_EOF
+        ev_error = select.KQ_EV_ERROR
         for event in res:
-            if event.ident == self.controlfd:
-                interrupted = True
+            ident = event.ident
+            handler = get_handler(ident)
+            if handler is None:
+                # See _dispatch_poll.
+                if ident == controlfd:
+                    interrupted = True
                 continue
-            handler = self.socket_list[event.ident]
-            if event.filter == select.KQ_FILTER_READ:
-                self.notifier.read_obj(handler)
-            if event.filter == select.KQ_FILTER_WRITE:
-                self.notifier.write_obj(handler)
-            if event.flags & select.KQ_EV_EOF:
-                self.notifier.close_obj(handler)
+            flags = event.flags
+            # A change that could not be applied, not an event.
+            if flags & ev_error:
+                continue
+            dispatch[event.filter](handler)
+            if flags & ev_eof:
+                close_obj(handler)
         
         if interrupted:
             self.do_interrupt()
+        self._run_timers()
     
     def close(self):
+        self.changes = []
         self.queue.close()
         for handler in self.socket_list.itervalues():
             self.notifier.cleanup_obj(handler)
+        self.socket_list = {}
+        self._count = 0
         super(KQueueSocketMap, self).close()
     
     def is_empty(self):
-        return not bool(self.socket_list)
+        return self._count == 0
 
 
 order = [SelectSocketMap, PollSocketMap, EPollSocketMap, KQueueSocketMap]
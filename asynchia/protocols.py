@@ -19,7 +19,6 @@
 """ Commonly used protocols. """
 
 import asynchia
-from asynchia.util import EMPTY_BYTES
 
 class LineHandler(asynchia.Handler):
     """ Use this for line-based protocols. """
@@ -27,15 +26,50 @@ class LineHandler(asynchia.Handler):
     buffer_size = 4096
     def __init__(self, transport=None):
         asynchia.Handler.__init__(self, transport)
-        self.read_buffer = EMPTY_BYTES
+        # Extended in place so that a long line arriving in many chunks
+        # is not copied on every read.
+        self._read_buffer = bytearray()
+        # Offset in read_buffer before which there is no delimiter.
+        self.scan_pos = 0
         if not self.transport.readable:
             self.transport.set_readable(True)
     
+    def get_read_buffer(self):
+        """ Return the bytearray holding the data not yet split into
+        lines. """
+        return self._read_buffer
+    
+    def set_read_buffer(self, buf):
+        """ Replace the buffer. Unless buf is the current buffer, which
+        may only have been extended (e.g. by +=), it is searched for the
+        delimiter from its start again. """
+        if buf is not self._read_buffer:
+            if not isinstance(buf, bytearray):
+                buf = bytearray(buf)
+            self._read_buffer = buf
+            self.scan_pos = 0
+    
+    read_buffer = property(get_read_buffer, set_read_buffer)
+    
     def split_buffer(self):
-        """ Split buffer into the different lines. """
-        split = self.read_buffer.split(self.delimiter)
-        self.read_buffer = split.pop()
-        return split
+        """ Split buffer into the different lines. Only the part of the
+        buffer that has not been searched before is searched for the
+        delimiter, and the lines are removed from it all at once. """
+        buf = self._read_buffer
+        delimiter = self.delimiter
+        find = buf.find
+        lines = []
+        start = 0
+        end = find(delimiter, self.scan_pos)
+        while end != -1:
+            lines.append(bytes(buf[start:end]))
+            start = end + len(delimiter)
+            end = find(delimiter, start)
+        if start:
+            del buf[:start]
+        # A delimiter may have been received partially.
+        self.scan_pos = max(0, len(buf) - len(delimiter) + 1)
+        return lines
     
     def parse_buffer(self):
         """ Call the line_received method for any lines delimited by
@@ -46,7 +80,7 @@ class LineHandler(asynchia.Handler):
     def handle_read(self):
         """ We got inbound data. Extend our buffer and see if we have
         got lines in it. """
-        self.read_buffer += self.transport.recv(self.buffer_size)
+        self._read_buffer.extend(self.transport.recv(self.buffer_size))
         self.parse_buffer()
     
     def send_line(self, line):
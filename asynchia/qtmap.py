@@ -20,126 +20,162 @@
 of the GNU GPL! """
 
 import asynchia
-import socket
-import errno
 
 from PyQt4 import QtCore, QtGui
 
+_READ = QtCore.QSocketNotifier.Read
+_WRITE = QtCore.QSocketNotifier.Write
+_EXCEPTION = QtCore.QSocketNotifier.Exception
+
 
 class SocketNotifier(QtCore.QSocketNotifier):
-    """ Notificate about socket I/O using Qt facilities """
-    def __init__(self, watched, notifier, type_ ):
-        QtCore.QSocketNotifier.__init__(self, watched.transport.fileno(), type_)
+    """ Notificate about socket I/O using Qt facilities. If throttle is
+    given, the notifier is disabled for throttle milliseconds after every
+    notification. """
+    def __init__(self, watched, notifier, type_, throttle=0):
+        QtCore.QSocketNotifier.__init__(self, watched.fileno(), type_)
         self.watched = watched
         self.notifier = notifier
-        self.fun = None
-        if type_ == QtCore.QSocketNotifier.Read:
-            self.fun = self.read
-        elif type_ == QtCore.QSocketNotifier.Write:
-            self.fun = self.write
-        elif type_ == QtCore.QSocketNotifier.Exception:
-            self.fun = self.except_
-        QtCore.QObject.connect(self, QtCore.SIGNAL("activated(int)"), self.fun)
+        self.throttle = throttle
+        # Whether the notifier should be enabled and whether it is
+        # currently disabled by the throttle.
+        self.wanted = True
+        self.throttled = False
+        if type_ == _READ:
+            action = notifier.read_obj
+        elif type_ == _WRITE:
+            action = notifier.write_obj
+        else:
+            action = notifier.except_obj
+        # Connect the signal to the notifier directly rather than
+        # through a method of ours; the fileno passed is not needed.
+        self.fun = lambda _sock, obj=watched, action=action: action(obj)
+        if throttle:
+            self.fun = self.throttled_fun(self.fun)
+        # Bound signals do not have to look the signature up by name.
+        self.activated.connect(self.fun)
+    
+    def throttled_fun(self, fun):
+        """ Return a function that calls fun and ignores further
+        notifications until throttle milliseconds have passed. """
+        def _fun(sock):
+            # The notifier is level-triggered, so it fires again once it
+            # is re-enabled if the handler has not read all the data.
+            self.setEnabled(False)
+            self.throttled = True
+            QtCore.QTimer.singleShot(self.throttle, self.unthrottle)
+            fun(sock)
+        return _fun
+    
+    def unthrottle(self):
+        """ Re-enable notification after the throttle has passed unless
+        the notifier has been disabled or shut down meanwhile. """
+        self.throttled = False
+        if self.fun is not None and self.wanted:
+            self.setEnabled(True)
     
     def disable(self):
         """ Temporarily disable notification on I/O. """
+        self.wanted = False
         self.setEnabled(False)
     
     def enable(self):
         """ Re-enable notification on I/O. """
-        self.setEnabled(True)
+        self.wanted = True
+        if not self.throttled:
+            self.setEnabled(True)
     
     def shutdown(self):
         """ Permanentely disable notification on I/O. """
-        QtCore.QObject.disconnect(
-            self, QtCore.SIGNAL("activated(int)"), self.fun
-        )
+        self.activated.disconnect(self.fun)
         self.setEnabled(False)
         self.fun = self.watched = None
         self.deleteLater()
-    
-    def read(self, _sock=None):
-        """ Read I/O to do. """
-        self.notifier.read_obj(self.watched)
-    
-    def write(self, _sock=None):
-        """ Write I/O to do. """
-        try:
-            self.watched.socket.getpeername()
-        except socket.error, err:
-            if err.args[0] == errno.ENOTCONN:
-                return
-            else:
-                raise
-        self.notifier.write_obj(self.watched)
-    
-    def except_(self, _sock=None):
-        """ Exception I/O to do. """
-        self.notifier.except_obj(self.watched)
 
 
 class QSocketMap(asynchia.SocketMap):
-    """ Decide which sockets have I/O to do using Qt facilities. """
-    def __init__(self, notifier=None):
+    """ Decide which sockets have I/O to do using Qt facilities.
+    
+    If throttle_read is given, read notifications of a handler are
+    coalesced so that handle_read is called at most once every
+    throttle_read milliseconds. This reduces the number of signals
+    dispatched for busy connections, but is only sensible if the
+    handlers read all available data in handle_read. """
+    def __init__(self, notifier=None, throttle_read=0):
         asynchia.SocketMap.__init__(self, notifier)
-        self.handler_map = {}
+        self.throttle_read = throttle_read
+        # The notifiers of each kind are kept in a dict of their own so
+        # that changing one costs a single lookup. Every handler has an
+        # exception notifier, the other ones are created on demand.
+        self.read_notifiers = {}
+        self.write_notifiers = {}
+        self.except_notifiers = {}
     
     def add_transport(self, handler):
         """ See asynchia.SocketMap.add_transport """
-        read = SocketNotifier(
-            handler, self.notifier, QtCore.QSocketNotifier.Read
+        # Still needed for out-of-band data.
+        self.except_notifiers[handler] = SocketNotifier(
+            handler, self.notifier, _EXCEPTION
         )
-        write = SocketNotifier(
-            handler, self.notifier, QtCore.QSocketNotifier.Write
-        )
-        exception = SocketNotifier(
-            handler, self.notifier, QtCore.QSocketNotifier.Exception
-        )
-        
+        # Many handlers are neither readable nor writeable when they
+        # are added, e.g. those of servers never write, so the read and
+        # write notifiers are only created once they are needed.
         if handler.readable:
-            read.enable()
-        else:
-            read.disable()
-        
+            self.add_reader(handler)
         if handler.writeable:
-            write.enable()
-        else:
-            write.disable()
-        exception.enable()
-        
-        self.handler_map[handler] = {
-            'read': read,
-            'write': write,
-            'exception': exception
-        }
+            self.add_writer(handler)
     
     def del_transport(self, handler):
         """ See asynchia.SocketMap.del_transport """
-        for notifier in self.handler_map[handler].iteritems():
-            notifier.shutdown()
-        del self.handler_map[handler]
+        self.except_notifiers.pop(handler).shutdown()
+        read = self.read_notifiers.pop(handler, None)
+        if read is not None:
+            read.shutdown()
+        write = self.write_notifiers.pop(handler, None)
+        if write is not None:
+            write.shutdown()
     
     def add_reader(self, handler):
         """ See asynchia.SocketMap.add_reader """
-        self.handler_map[handler]['read'].enable()
+        read = self.read_notifiers.get(handler)
+        if read is None:
+            # QSocketNotifiers are enabled when they are created.
+            self.read_notifiers[handler] = SocketNotifier(
+                handler, self.notifier, _READ, self.throttle_read
+            )
+        else:
+            read.enable()
     
     def del_reader(self, handler):
         """ See asynchia.SocketMap.del_reader """
-        self.handler_map[handler]['read'].disable()
+        read = self.read_notifiers.get(handler)
+        if read is not None:
+            read.disable()
     
     def add_writer(self, handler):
         """ See asynchia.SocketMap.add_writer """
-        self.handler_map[handler]['write'].enable()
+        write = self.write_notifiers.get(handler)
+        if write is None:
+            # QSocketNotifiers are enabled when they are created.
+            self.write_notifiers[handler] = SocketNotifier(
+                handler, self.notifier, _WRITE
+            )
+        else:
+            write.enable()
     
     def del_writer(self, handler):
         """ See asynchia.SocketMap.del_writer """
-        self.handler_map[handler]['write'].disable()
+        write = self.write_notifiers.get(handler)
+        if write is not None:
+            write.disable()
     
     def close(self):
         """ See asynchia.SocketMap.close """
-        for handler in self.handler_map:
+        for handler in self.except_notifiers.keys():
             self.notifier.cleanup_obj(handler)
-        self.handler_map.clear()
+        self.read_notifiers.clear()
+        self.write_notifiers.clear()
+        self.except_notifiers.clear()
     
     def is_empty(self):
-        return bool(self.handler_map)
+        return not self.except_notifiers
@@ -27,6 +27,9 @@ from asynchia.util import is_closed
 
 
 class SSLSocketTransport(asynchia.SocketTransport):
+    # The data has to be encrypted before it is sent.
+    sendfile = None
+    
     def __init__(self, socket_map, sock=None, handler=None,
                  keyfile=None, certfile=None, server_side=False,
                  cert_reqs=0, ssl_version=2, ca_certs=None):
@@ -56,12 +59,6 @@ class SSLSocketTransport(asynchia.SocketTransport):
         else:
             asynchia.SocketTransport.set_writeable(self, value)
     
-    def get_readable(self):
-        return asynchia.SocketTransport.get_readable(self)
-    
-    def get_writeable(self):
-        return asynchia.SocketTransport.get_writeable(self)
-    
     def set_socket(self, sock):
         sock = ssl.wrap_socket(
                 sock, self.keyfile, self.certfile, self.server_side,
@@ -73,16 +70,16 @@ class SSLSocketTransport(asynchia.SocketTransport):
     
     def _do_handshake(self):
         try:
-            # Reset read- and writeability.
-            self.set_readable(False, True)
-            self.set_writeable(False, True)
-            
             self.socket.do_handshake()
         
         except ssl.SSLError, err:
+            # Only wait for the direction OpenSSL needs. Setting one
+            # that has not changed does not touch the socket-map.
             if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.set_writeable(False, True)
                 self.set_readable(True, True)
             elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.set_readable(False, True)
                 self.set_writeable(True, True)
             else:
                 raise
@@ -108,20 +105,23 @@ class SSLSocketTransport(asynchia.SocketTransport):
     def handle_write(self):
         if self.shook_hands:
             asynchia.SocketTransport.handle_write(self)
-        
-        self._do_handshake()
+        else:
+            self._do_handshake()
     
     def handle_read(self):
         if self.shook_hands:
             asynchia.SocketTransport.handle_read(self)
-        
-        self._do_handshake()
+        else:
+            self._do_handshake()
     
-    writeable = property(get_writeable, set_writeable)
-    readable = property(get_readable, set_readable)
+    # The properties of SocketTransport would call its setters.
+    writeable = property(
+        asynchia.SocketTransport.get_writeable, set_writeable
+    )
+    readable = property(asynchia.SocketTransport.get_readable, set_readable)
     
     def is_closed(self):
-        return is_closed(self.socket._sock)
+        return self.closed or is_closed(self.socket._sock)
 
 
 if __name__ == '__main__':
@@ -18,18 +18,25 @@
 
 from __future__ import with_statement
 
+import sys
 import time
 import errno
+import os
 import socket
+import select
+import struct
 import threading
 
 import asynchia
 import asynchia.maps
 import asynchia.util
 
+import asynchia.ee
 import asynchia.forthcoming
+import asynchia.protocols
 
 b = asynchia.util.b
+EMPTY_BYTES = asynchia.util.EMPTY_BYTES
 
 import unittest
 
@@ -368,6 +375,23 @@ def dnr_connfailed(self, map_):
         mo.poll(abs(TIMEOUT - (time.time() - s)))
     self.assertEqual(container['done'], True)
 
+def dnr_close_connecting(self, map_):
+    mo = map_()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    
+    c = asynchia.Handler(asynchia.SocketTransport(mo))
+    c.transport.set_writeable(True)
+    c.transport.connect(listener.getsockname())
+    try:
+        # Writeable and awaiting the connect at the same time.
+        c.transport.close()
+        self.assertEqual(mo.is_empty(), True)
+    finally:
+        listener.close()
+        mo.close()
+
 def dnr_connfailed2(self, map_):
     container = {'done': False}
     
@@ -414,6 +438,179 @@ def dnr_closed(self, map_):
     self.assertRaises(asynchia.SocketMapClosedError, mo.poll, TIMEOUT)
 
 
+def dnr_closed_wakeup(self, map_):
+    mo = map_()
+    mo.close()
+    # Likely to be given the fds of the closed control channel.
+    r, w = os.pipe()
+    try:
+        self.assertRaises(
+            asynchia.SocketMapClosedError,
+            mo.call_synchronized, lambda: None
+        )
+        mo.drain_control()
+        if os.name == 'posix':
+            self.assertEqual(select.select([r], [], [], 0)[0], [])
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def dnr_oob(self, map_):
+    container = {'read': False, 'except': False}
+    
+    class Handler(asynchia.Handler):
+        def __init__(self, transport):
+            asynchia.Handler.__init__(self, transport)
+            self.transport.set_readable(True)
+        
+        def handle_read(self):
+            container['read'] = True
+        
+        def handle_except(self, err):
+            container['except'] = True
+        
+        # Prevent exception from being suppressed.
+        def handle_error(self):
+            raise
+    
+    acceptor = socket.socket()
+    acceptor.bind(('127.0.0.1', 0))
+    acceptor.listen(1)
+    
+    client = socket.socket()
+    client.connect(acceptor.getsockname())
+    conn = acceptor.accept()[0]
+    acceptor.close()
+    
+    mo = map_()
+    Handler(asynchia.SocketTransport(mo, conn))
+    client.send(b('x'), socket.MSG_OOB)
+    
+    s = time.time()
+    while not container['except'] and time.time() < s + TIMEOUT:
+        mo.poll(abs(TIMEOUT - (time.time() - s)))
+    mo.close()
+    client.close()
+    self.assertEqual(container['except'], True)
+    self.assertEqual(container['read'], False)
+
+
+def dnr_is_empty(self, map_):
+    mo = map_()
+    self.assertEqual(mo.is_empty(), True)
+    
+    a, c = asynchia.util.socketpair()
+    ha = asynchia.Handler(asynchia.SocketTransport(mo, a))
+    self.assertEqual(mo.is_empty(), False)
+    
+    hc = asynchia.Handler(asynchia.SocketTransport(mo, c))
+    ha.transport.close()
+    self.assertEqual(mo.is_empty(), False)
+    
+    hc.transport.close()
+    self.assertEqual(mo.is_empty(), True)
+    mo.close()
+
+
+def dnr_toggle_writeable(self, map_):
+    mo = map_()
+    container = {'writes': 0}
+    
+    class Handler(asynchia.Handler):
+        def handle_write(self):
+            container['writes'] += 1
+            self.transport.set_writeable(False)
+    
+    a, c = asynchia.util.socketpair()
+    ha = Handler(asynchia.SocketTransport(mo, a))
+    hc = asynchia.Handler(asynchia.SocketTransport(mo, c))
+    # Let the socket-map know which thread polls it.
+    mo.poll(0)
+    
+    ha.transport.set_writeable(True)
+    ha.transport.set_writeable(False)
+    mo.poll(0)
+    self.assertEqual(container['writes'], 0)
+    
+    ha.transport.set_writeable(True)
+    ha.transport.set_writeable(False)
+    ha.transport.set_writeable(True)
+    s = time.time()
+    while not container['writes'] and time.time() < s + TIMEOUT:
+        mo.poll(abs(TIMEOUT - (time.time() - s)))
+    self.assertEqual(container['writes'], 1)
+    mo.close()
+
+
+def dnr_toggle_threaded(self, map_):
+    writes = []
+    
+    class Notifier(asynchia.Notifier):
+        # Record every write event the map reports, including those the
+        # default notifier would drop for handlers that are not writeable.
+        @staticmethod
+        def write_obj(obj):
+            writes.append(obj.writeable)
+            asynchia.Notifier.write_obj(obj)
+    
+    class Handler(asynchia.Handler):
+        def handle_write(self):
+            self.transport.set_writeable(False)
+    
+    mo = map_(Notifier())
+    a, c = asynchia.util.socketpair()
+    h = Handler(asynchia.SocketTransport(mo, a))
+    done = threading.Event()
+    
+    def toggle():
+        for n in xrange(5000):
+            h.transport.set_writeable(n % 2 == 0)
+        h.transport.set_writeable(False)
+        done.set()
+    
+    # Switch threads as often as possible to provoke races.
+    if hasattr(sys, 'setswitchinterval'):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        restore = lambda: sys.setswitchinterval(interval)
+    else:
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        restore = lambda: sys.setcheckinterval(interval)
+    try:
+        threading.Thread(target=toggle).start()
+        s = time.time()
+        while not done.isSet() and time.time() < s + TIMEOUT:
+            mo.poll(0.001)
+    finally:
+        restore()
+    # Apply the changes deferred by the last poll.
+    mo.poll(0)
+    
+    # The handler does not want to write anymore, so it must not be
+    # reported writeable again.
+    del writes[:]
+    for _ in xrange(5):
+        mo.poll(0.01)
+    mo.close()
+    c.close()
+    self.assertEqual(done.isSet(), True)
+    self.assertEqual(writes, [])
+
+
+def dnr_wakeup_once(self, map_):
+    mo = map_()
+    for _ in xrange(3):
+        mo.wakeup()
+    # All pending wakeups are consumed at once.
+    mo.poll(TIMEOUT)
+    s = time.time()
+    mo.poll(0.2)
+    self.assertTrue(time.time() - s >= 0.1)
+    mo.close()
+
+
 class TestCore(unittest.TestCase):    
     def test_error(self):
         container = {'done': False}
@@ -480,6 +677,218 @@ class TestCore(unittest.TestCase):
     
     if hasattr(socket, 'socketpair'):
         test_pingpong2 = _override_socketpair(test_pingpong)
+    
+    def test_line_handler(self):
+        lines = []
+        
+        class Handler(asynchia.protocols.LineHandler):
+            delimiter = b('\r\n')
+            
+            def line_received(self, line):
+                lines.append(line)
+        
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        try:
+            h = Handler(asynchia.SocketTransport(mo, a))
+            for chunk in [b('Foo\r'), b('\nBar'), b('\r\n\r\nB'), b('az\r')]:
+                h.read_buffer.extend(chunk)
+                h.parse_buffer()
+            self.assertEqual(lines, [b('Foo'), b('Bar'), b('')])
+            self.assertEqual(bytes(h.read_buffer), b('Baz\r'))
+        finally:
+            mo.close()
+            c.close()
+    
+    def test_line_handler_replace_buffer(self):
+        lines = []
+        
+        class Handler(asynchia.protocols.LineHandler):
+            delimiter = b('\r\n')
+            
+            def line_received(self, line):
+                lines.append(line)
+        
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        try:
+            h = Handler(asynchia.SocketTransport(mo, a))
+            h.read_buffer += b('Foo Bar')
+            h.parse_buffer()
+            # Replacing the buffer must not skip the start of the new one.
+            h.read_buffer = b('Baz\r\n')
+            h.parse_buffer()
+            h.read_buffer += b('Spam Eggs')
+            h.parse_buffer()
+            h.read_buffer = h.read_buffer[5:]
+            h.read_buffer += b('\r\n')
+            h.parse_buffer()
+            self.assertEqual(lines, [b('Baz'), b('Eggs')])
+            self.assertEqual(bytes(h.read_buffer), b(''))
+        finally:
+            mo.close()
+            c.close()
+    
+    def test_sendall(self):
+        class SendAllTransport(asynchia.SendallTrait, asynchia.SocketTransport):
+            pass
+        
+        data = [b('a') * 10, b('b') * 200000, b('c'), b('d') * 3000]
+        expected = EMPTY_BYTES.join(data)
+        received = []
+        
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        ha = asynchia.Handler(SendAllTransport(mo, a))
+        hc = asynchia.Handler(asynchia.SocketTransport(mo, c))
+        hc.transport.set_readable(True)
+        hc.handle_read = lambda: received.append(hc.transport.recv(65536))
+        for chunk in data:
+            ha.transport.sendall(chunk)
+        
+        s = time.time()
+        while (sum(map(len, received)) < len(expected) and
+               time.time() < s + TIMEOUT):
+            mo.poll(abs(TIMEOUT - (time.time() - s)))
+        mo.close()
+        self.assertEqual(EMPTY_BYTES.join(received), expected)
+    
+    def test_sendall_transform(self):
+        class UpperTransport(asynchia.SocketTransport):
+            def send(self, data):
+                # Expects a string and sends only part of it.
+                return asynchia.SocketTransport.send(
+                    self, data[:1000].upper()
+                )
+        
+        class SendAllTransport(asynchia.SendallTrait, UpperTransport):
+            pass
+        
+        # The end of the last chunk is left on its own after partial
+        # sends.
+        data = [b('a') * 10, b('b') * 5000]
+        expected = EMPTY_BYTES.join(data).upper()
+        received = []
+        
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        ha = asynchia.Handler(SendAllTransport(mo, a))
+        hc = asynchia.Handler(asynchia.SocketTransport(mo, c))
+        hc.transport.set_readable(True)
+        hc.handle_read = lambda: received.append(hc.transport.recv(65536))
+        for chunk in data:
+            ha.transport.sendall(chunk)
+        
+        s = time.time()
+        while (sum(map(len, received)) < len(expected) and
+               time.time() < s + TIMEOUT):
+            mo.poll(abs(TIMEOUT - (time.time() - s)))
+        mo.close()
+        self.assertEqual(EMPTY_BYTES.join(received), expected)
+    
+    def test_sendall_large(self):
+        class SendAllTransport(asynchia.SendallTrait, asynchia.SocketTransport):
+            pass
+        
+        large = EMPTY_BYTES.join(
+            struct.pack('!I', n) for n in xrange(2 ** 21)
+        )
+        data = [b('a'), large, b('b') * 10, large[::-1], b('c')]
+        expected = EMPTY_BYTES.join(data)
+        received = []
+        
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        ha = asynchia.Handler(SendAllTransport(mo, a))
+        hc = asynchia.Handler(asynchia.SocketTransport(mo, c))
+        hc.transport.set_readable(True)
+        hc.handle_read = lambda: received.append(hc.transport.recv(65536))
+        for chunk in data:
+            ha.transport.sendall(chunk)
+        
+        s = time.time()
+        while (sum(map(len, received)) < len(expected) and
+               time.time() < s + TIMEOUT):
+            mo.poll(abs(TIMEOUT - (time.time() - s)))
+        mo.close()
+        self.assertEqual(EMPTY_BYTES.join(received), expected)
+    
+    def test_fileinput(self):
+        data = open(__file__, 'rb').read()
+        received = []
+        
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        ha = asynchia.ee.Handler(asynchia.SocketTransport(mo, a))
+        hc = asynchia.Handler(asynchia.SocketTransport(mo, c))
+        hc.transport.set_readable(True)
+        hc.handle_read = lambda: received.append(hc.transport.recv(65536))
+        ha.send_input(asynchia.ee.FileInput.from_filename(__file__))
+        
+        s = time.time()
+        while (sum(map(len, received)) < len(data) and
+               time.time() < s + TIMEOUT):
+            mo.poll(abs(TIMEOUT - (time.time() - s)))
+        mo.close()
+        self.assertEqual(EMPTY_BYTES.join(received), data)
+    
+    def test_is_closed(self):
+        mo = asynchia.maps.DefaultSocketMap()
+        a, c = asynchia.util.socketpair()
+        t = asynchia.SocketTransport(mo, a)
+        c.close()
+        self.assertEqual(t.recv(1), EMPTY_BYTES)
+        # The socket is not probed again after the transport was closed.
+        t.socket = None
+        self.assertEqual(t.is_closed(), True)
+        mo.close()
+        a.close()
+    
+    if os.name != 'nt':
+        def test_select_full(self):
+            class Handler(object):
+                readable = writeable = False
+                
+                def fileno(self):
+                    return asynchia.maps._FD_SETSIZE
+            
+            mo = asynchia.maps.SelectSocketMap()
+            try:
+                self.assertRaises(
+                    asynchia.SocketMapFullError, mo.add_transport, Handler()
+                )
+                self.assertEqual(mo.is_empty(), True)
+            finally:
+                mo.close()
+    
+    if asynchia.maps.EPollSocketMap.available and asynchia.maps._SO_BUSY_POLL:
+        def test_busy_poll(self):
+            mo = asynchia.maps.EPollSocketMap(busy_poll=50)
+            a, c = asynchia.util.socketpair()
+            try:
+                a.setsockopt(socket.SOL_SOCKET, asynchia.maps._SO_BUSY_POLL, 0)
+            except socket.error:
+                # Not supported by the kernel or not permitted.
+                mo.close()
+                return
+            ha = asynchia.Handler(asynchia.SocketTransport(mo, a))
+            try:
+                self.assertEqual(
+                    a.getsockopt(
+                        socket.SOL_SOCKET, asynchia.maps._SO_BUSY_POLL
+                    ),
+                    50
+                )
+            finally:
+                mo.close()
+                c.close()
+
+class _EdgeTriggeredEPollSocketMap(asynchia.maps.EPollSocketMap):
+    def __init__(self, notifier=None):
+        asynchia.maps.EPollSocketMap.__init__(
+            self, notifier, edge_triggered=True
+        )
+
 
 def _genfun(map_, test):
     def _fun(self):
@@ -492,6 +901,7 @@ maps = \
           asynchia.maps.SelectSocketMap,
           asynchia.maps.PollSocketMap,
           asynchia.maps.EPollSocketMap,
+          _EdgeTriggeredEPollSocketMap,
           asynchia.maps.KQueueSocketMap,
       ]
       if map_.available
@@ -504,7 +914,10 @@ wsocketpair = [
 
 tests = [
     dnr_interrupt, t_changeflag(ctx), t_changeflag(std),
-    dnr_remove, dnr_remove2, dnr_closed
+    dnr_remove, dnr_remove2, dnr_closed, dnr_closed_wakeup, dnr_oob,
+    dnr_is_empty,
+    dnr_toggle_writeable, dnr_toggle_threaded, dnr_wakeup_once,
+    dnr_close_connecting
 ] + wsocketpair
 
 if hasattr(socket, 'socketpair'):
@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import os
 import string
 import struct
@@ -54,9 +55,40 @@ def del_strcoll(size):
         asynchia.ee.StringCollector(), size
     )
 
-def until_done(fun):
+class SendfileTransport(asynchia.SocketTransport):
+    """ Pretend to send files with sendfile, at most limit bytes at a
+    time. The socket is full the first time. """
+    class Socket(object):
+        def __init__(self, transport):
+            self.transport = transport
+        
+        def send(self, data, flags=0):
+            self.transport.outbuf += data
+            return len(data)
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.outbuf = b('')
+        self.calls = 0
+        self.socket = self.Socket(self)
+    
+    def sendfile(self, fd, offset, nbytes):
+        self.calls += 1
+        if self.calls == 1:
+            return 0
+        f = open(fd.name, 'rb')
+        try:
+            f.seek(offset)
+            data = f.read(min(nbytes, self.limit))
+        finally:
+            f.close()
+        self.outbuf += data
+        return len(data)
+
+
+def until_done(fun, *args):
     while True:
-        d, s = fun()
+        d, s = fun(*args)
         if d:
             break
 
@@ -68,7 +100,7 @@ class TestEE(unittest.TestCase):
         d = asynchia.ee.StringInput(b('c') * 5)
         q = asynchia.ee.InputQueue([a, c, d])
         
-        until_done(lambda: q.tick(m))
+        until_done(q.tick, m)
         self.assertEqual(m.outbuf, b('a') * 5 + b('b') * 5 + b('c') * 5)
     
     
@@ -84,11 +116,72 @@ class TestEE(unittest.TestCase):
         m = asynchia.ee.MockHandler()
         i = asynchia.ee.FileInput.from_filename(__file__)
         self.assertEqual(len(i), len(data))
-        until_done(lambda: i.tick(m))
+        until_done(i.tick, m)
         i.close()
         self.assertEqual(m.outbuf, data)
     
     
+    def test_fileinput_sendfile(self):
+        data = open(__file__, 'rb').read()
+        t = SendfileTransport(1000)
+        i = asynchia.ee.FileInput.from_filename(__file__)
+        until_done(i.tick, t)
+        self.assertEqual(t.outbuf, data)
+        self.assertTrue(t.calls > len(data) // 1000)
+    
+    def test_fileinput_sendfile_short(self):
+        fd = get_named_tempfile(delete=True)
+        try:
+            fd.write(b('a') * 10)
+            fd.flush()
+            fd.seek(0)
+            t = SendfileTransport(1000)
+            # The file is shorter than the length passed.
+            i = asynchia.ee.FileInput(fd, 100, closing=False)
+            for _ in xrange(10):
+                if i.tick(t)[0]:
+                    break
+            else:
+                self.fail("FileInput did not stop at the end of the file.")
+            self.assertEqual(t.outbuf, b('a') * 10)
+        finally:
+            fd.close()
+    
+    def test_fileinput_sendfile_pipe(self):
+        data = b('a') * 10
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+        fd = os.fdopen(r, 'rb')
+        try:
+            t = SendfileTransport(1000)
+            i = asynchia.ee.FileInput(fd, len(data), closing=False)
+            until_done(i.tick, t)
+            self.assertEqual(t.calls, 0)
+            self.assertEqual(t.outbuf, data)
+        finally:
+            fd.close()
+    
+    def test_fileinput_sendfile_filelike(self):
+        data = b(string.ascii_letters)
+        t = SendfileTransport(1000)
+        i = asynchia.ee.FileInput(io.BytesIO(data), len(data))
+        until_done(i.tick, t)
+        self.assertEqual(t.calls, 0)
+        self.assertEqual(t.outbuf, data)
+    
+    def test_fileinput_send_overridden(self):
+        class Transport(SendfileTransport):
+            def send(self, data):
+                self.outbuf += data.upper()
+                return len(data)
+        
+        t = Transport(1000)
+        i = asynchia.ee.FileInput.from_filename(__file__)
+        until_done(i.tick, t)
+        self.assertEqual(t.calls, 0)
+        self.assertEqual(t.outbuf, open(__file__, 'rb').read().upper())
+    
     def test_fileinput_closing(self):
         i = asynchia.ee.FileInput.from_filename(__file__)
         i.close()
@@ -130,9 +223,7 @@ class TestEE(unittest.TestCase):
     
     
     def test_delimited(self):
-        c = asynchia.ee.DelimitedCollector(
-            asynchia.ee.StringCollector(), 5
-        )
+        c = del_strcoll(5)
         m = asynchia.ee.MockHandler(inbuf=b(string.ascii_letters))
         n = c.add_data(m, 10)
         self.assertEqual(n[1], 5)
@@ -144,21 +235,24 @@ class TestEE(unittest.TestCase):
         self.assertEqual(m.inbuf, b(string.ascii_letters[5:]))
         
     
+    def test_slots(self):
+        q = asynchia.ee.CollectorQueue([del_strcoll(5)])
+        for c in [q, q.collectors[0], q.collectors[0].collector]:
+            self.assertFalse(hasattr(c, '__dict__'))
+        # Subclasses without __slots__ can still store arbitrary attributes.
+        k = asynchia.ee.KeepingCollectorQueue()
+        k.foo = 1
+        self.assertEqual(k.foo, 1)
+    
     def test_collectorqueue(self):
-        a = asynchia.ee.DelimitedCollector(
-            asynchia.ee.StringCollector(), 5
-        )
-        c = asynchia.ee.DelimitedCollector(
-            asynchia.ee.StringCollector(), 4
-        )
-        d = asynchia.ee.DelimitedCollector(
-            asynchia.ee.StringCollector(), 3
-        )
+        a = del_strcoll(5)
+        c = del_strcoll(4)
+        d = del_strcoll(3)
         
         q = asynchia.ee.CollectorQueue([a, c, d])
         
         m = asynchia.ee.MockHandler(inbuf=b('a') * 5 + b('b') * 4 + b('c') * 3)
-        until_done(lambda: q.add_data(m, 5))
+        until_done(q.add_data, m, 5)
         self.assertEqual(a.collector.value, b('a') * 5)
         self.assertEqual(c.collector.value, b('b') * 4)
         self.assertEqual(d.collector.value, b('c') * 3)
@@ -176,7 +270,7 @@ class TestEE(unittest.TestCase):
             )
         m = asynchia.ee.MockHandler(
             inbuf=b('a') * 5 + b('b') * 5 + b('c') * 5 + b('d'))
-        until_done(lambda: c.add_data(m, 5))
+        until_done(c.add_data, m, 5)
         self.assertEqual(c.add_data(m, 1)[0], True)
         
     
@@ -187,13 +281,13 @@ class TestEE(unittest.TestCase):
             asynchia.ee.FactoryInput.wrap_iterator(itr.next)
             )
         m = asynchia.ee.MockHandler()
-        until_done(lambda: c.tick(m))
+        until_done(c.tick, m)
         self.assertEqual(m.outbuf, b('a') * 5 + b('b') * 5 + b('c') * 5)
         self.assertEqual(c.tick(m)[0], True)
     
     
     def test_close(self):
-        c = asynchia.ee.DelimitedCollector(asynchia.ee.StringCollector(), 5)
+        c = del_strcoll(5)
         m = asynchia.ee.MockHandler(b('abcde'))
         c.add_data(m, 10)
         self.assertEqual(c.closed, True)
@@ -206,7 +300,7 @@ class TestEE(unittest.TestCase):
         q += asynchia.ee.StringInput(b('c'))
         id2 = id(q)
         self.assertEqual(id1, id2)
-        until_done(lambda: q.tick(m))
+        until_done(q.tick, m)
         self.assertEqual(m.outbuf, b('abc'))
     
     
@@ -220,16 +314,20 @@ class TestEE(unittest.TestCase):
     
     def test_lenpredict(self):
         strings = [b('a') * i for i in xrange(1, 20)]
-        for string in strings:
-            fd = get_named_tempfile(delete=True)
-            try:
+        # One file is rewritten for all strings rather than creating a
+        # file for each of them.
+        fd = get_named_tempfile(delete=True)
+        try:
+            for string in strings:
+                fd.seek(0)
+                fd.truncate()
                 fd.write(string)
                 fd.flush()
                 fd.seek(0)
-                c = asynchia.ee.FileInput(fd)
+                c = asynchia.ee.FileInput(fd, closing=False)
                 self.assertEqual(len(c), len(string))
-            finally:
-                fd.close()
+        finally:
+            fd.close()
     
     
     def test_fromfilename(self):
@@ -238,16 +336,21 @@ class TestEE(unittest.TestCase):
             for i in xrange(1, 20)
             for j in xrange(1, 20)
         ]
-        for string in strings:
-            fd = get_named_tempfile(delete=True)
-            try:
+        # See test_lenpredict.
+        fd = get_named_tempfile(delete=True)
+        try:
+            for string in strings:
+                fd.seek(0)
+                fd.truncate()
                 fd.write(string)
                 fd.flush()
-                fd.seek(0)
                 c = asynchia.ee.FileInput.from_filename(fd.name, 'r')
-                self.assertEqual(len(c), len(string))
-            finally:
-                fd.close()
+                try:
+                    self.assertEqual(len(c), len(string))
+                finally:
+                    c.close()
+        finally:
+            fd.close()
     
     
     def test_collectoradd(self):
@@ -256,7 +359,7 @@ class TestEE(unittest.TestCase):
         
         q = a + c
         m = asynchia.ee.MockHandler(b('a') * 5 + b('b') * 6)
-        until_done(lambda: q.add_data(m, 2))
+        until_done(q.add_data, m, 2)
         self.assertEqual(a.collector.value, b('a') * 5)
         self.assertEqual(c.collector.value, b('b') * 6)
     
@@ -268,7 +371,7 @@ class TestEE(unittest.TestCase):
         i = 0
         m = asynchia.ee.MockHandler(b('a') * 20000000)
         
-        while m.inbuf:
+        while m.inpos < 20000000:
             d, n = fc.add_data(m, 8000000)
             i += n
             
@@ -279,8 +382,16 @@ class TestEE(unittest.TestCase):
         s = struct.Struct('!dh')
         c = asynchia.ee.StructCollector(s)
         m = asynchia.ee.MockHandler(s.pack(14, 25))
-        until_done(lambda: c.add_data(m, 2))
+        until_done(c.add_data, m, 2)
         self.assertEqual(c.value, (14, 25))
+    
+    def test_strucollector_truncated(self):
+        s = struct.Struct('!dh')
+        c = asynchia.ee.StructCollector(s)
+        m = asynchia.ee.MockHandler(s.pack(14, 25)[:4])
+        c.add_data(m, 4)
+        self.assertRaises(struct.error, c.close)
+        self.assertEqual(c.value, None)
 
 
 if __name__ == '__main__':
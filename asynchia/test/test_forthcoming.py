@@ -23,6 +23,9 @@ import threading
 import asynchia.maps
 import asynchia.forthcoming as fc
 
+# Upper bound for waiting on another thread; only reached on failure.
+TIMEOUT = 5
+
 class Container(object): pass
 
 def dnr_inject(self, map_):
@@ -50,9 +53,12 @@ def dnr_inject(self, map_):
     
     threading.Thread(target=in_thread, args=(noti, container)).start()
     
+    # Each poll blocks until inject wakes the socket-map up, so this only
+    # loops on spurious wakeups.
     s = time.time()
-    while not container.run and time.time() < s + 10:
-        mo.poll(abs(10 - (time.time() - s)))
+    while not noti.finished and time.time() < s + TIMEOUT:
+        mo.poll(abs(TIMEOUT - (time.time() - s)))
+    mo.close()
     self.assertEquals(container.run, True)
     self.assertEquals(container.main_thread, False)
     
@@ -71,6 +77,7 @@ def dnr_databack_beforedata(self, map_):
     noti.add_databack(mkfun(container))
     self.assertEquals(container.run, False)
     noti.submit("foobar")
+    mo.close()
     self.assertEquals(container.run, True)
 
 
@@ -87,6 +94,7 @@ def dnr_databack_afterdata(self, map_):
     noti = fc.DataNotifier(mo)
     noti.submit("foobar")
     noti.add_databack(mkfun(container))
+    mo.close()
     self.assertEquals(container.run, True)
 
 
@@ -116,6 +124,7 @@ def dnr_coroutines(self, map_):
     conoti.add_databack(mkfun(container))
     self.assertEquals(container.run, False)
     noti.submit("foobar")
+    mo.close()
     self.assertEquals(container.run, True)
 
 
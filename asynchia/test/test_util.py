@@ -41,6 +41,10 @@ class TestUtil(unittest.TestCase):
         [self.assertEqual(pool.get(), n) for n in xrange(3)]
         pool.release(1)
         self.assertEqual(pool.get(), 1)
+        pool.release(2)
+        pool.release(0)
+        self.assertEqual(pool.get(), 0)
+        self.assertEqual(pool.get(), 2)
         [pool.release(n) for n in xrange(3)]
         self.assertEqual(pool.free_ids, [])
     
@@ -52,6 +56,9 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(
             asynchia.util.parse_ipv4('127.0.0.1'), ('127.0.0.1', -1)
         )
+        self.assertRaises(
+            ValueError, asynchia.util.parse_ipv4, '127.0.0.1:1:2'
+        )
     
     
     def test_ipv6(self):
@@ -67,6 +74,9 @@ class TestUtil(unittest.TestCase):
                 ),
             ('2001:0db8:85a3:08d3:1319:8a2e:0370:7344', -1)
         )
+        self.assertEqual(asynchia.util.parse_ipv6('[::1]'), ('::1', -1))
+        for string in ['[::1', '::1]:443', '[::1]443']:
+            self.assertRaises(ValueError, asynchia.util.parse_ipv6, string)
     
     
     def test_ip(self):
@@ -80,6 +90,15 @@ class TestUtil(unittest.TestCase):
             ('2001:0db8:85a3:08d3:1319:8a2e:0370:7344', 443)
         )
     
+    def test_goodsize(self):
+        for maxsize, size in [(1, 1), (4095, 2048), (4096, 4096),
+                              (4096.5, 4096), (2 ** 40 + 1, 2 ** 40)]:
+            good = asynchia.util.goodsize(maxsize)
+            self.assertEqual(good, size)
+            # Suitable for socket.recv, which does not accept floats.
+            self.assertTrue(isinstance(good, (int, long)))
+        self.assertRaises(ValueError, asynchia.util.goodsize, 0)
+    
     def test_gradualaverage(self):
         avg = asynchia.util.GradualAverage()
         avg2 = asynchia.util.GradualAverage()
@@ -105,6 +124,14 @@ class TestUtil(unittest.TestCase):
         
         self.assertAlmostEqual(avg.avg, avg2.avg)
         self.assertAlmostEqual(avg.avg, sum(s[-10:]) / float(len(s[-10:])))
+        self.assertAlmostEqual(
+            asynchia.util.LimitedAverage(10, s).avg, avg.avg
+        )
+        # The average follows values added after it has been read.
+        avg.add_values(s[:10])
+        avg2.add_value(s[0])
+        self.assertAlmostEqual(avg.avg, sum(s[:10]) / 10.0)
+        self.assertAlmostEqual(avg2.avg, sum(s[-9:] + s[:1]) / 10.0)
     
     def test_lookupstack(self):
         stack = asynchia.util.LookupStack({'fall': 'back'})
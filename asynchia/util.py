@@ -20,7 +20,7 @@
 
 import sys
 import errno
-import math
+import heapq
 import socket
 import threading
 import collections
@@ -113,41 +113,40 @@ class LimitedAverage(object):
     deque and thus has a higher memory usage than GradualAverage (and a
     different use case). """
     def __init__(self, samples, values=None):
-        self.cache = None
-        
         self.samples = samples
+        # The deque drops the oldest values itself once it holds
+        # samples of them.
         if values is None:
-            self.values = collections.deque()
+            self.values = collections.deque(maxlen=samples)
         else:
-            self.values = collections.deque(values)
-        
-            for _ in xrange(len(values) - samples):
-                self.values.popleft()
+            self.values = collections.deque(values, samples)
+        # Kept up to date as values come and go, so that avg does not
+        # have to sum up all the samples.
+        self.sum = sum(self.values)
     
     def add_value(self, value):
         """ Add value to the average. """
-        # Invalidate possibly existing cache.
-        self.cache = None
         if len(self.values) == self.samples:
-            self.values.popleft()
+            self.sum -= self.values[0]
         self.values.append(value)
+        self.sum += value
     
     def add_values(self, values):
         """ Add values to the average. This is more effective than using
         add_value multiple times. """
-        # Invalidate possibly existing cache.
-        self.cache = None
-        self.values.extend(values)
-        for _ in xrange(len(values) - self.samples):
-            self.values.popleft()
+        samples = self.samples
+        deque = self.values
+        total = self.sum
+        for value in values:
+            if len(deque) == samples:
+                total -= deque[0]
+            deque.append(value)
+            total += value
+        self.sum = total
     
     @property
     def avg(self):
-        if self.cache is not None:
-            return self.cache
-        else:
-            self.cache = sum(self.values) / float(len(self.values))
-            return self.cache
+        return self.sum / float(len(self.values))
 
 
 class IDPool(object):
@@ -156,6 +155,7 @@ class IDPool(object):
     
     Identifierers obtained using the get method are guaranteed to not be
     returned by it again until they are released using the release method.
+    The smallest identifier available is returned, so they stay dense.
     
         >>> pool = IDPool()
         >>> pool.get()
@@ -171,6 +171,7 @@ class IDPool(object):
     """
     def __init__(self):
         self.max_id = -1
+        # Heap of the released identifiers.
         self.free_ids = []
         
         self._lock = threading.Lock()
@@ -181,7 +182,7 @@ class IDPool(object):
         self._lock.acquire()
         try:
             if self.free_ids:
-                return self.free_ids.pop()
+                return heapq.heappop(self.free_ids)
             else:
                 self.max_id += 1
                 return self.max_id
@@ -194,7 +195,7 @@ class IDPool(object):
         Will reset the IDPool if the last id in use is released. """
         self._lock.acquire()
         try:
-            self.free_ids.append(id_)
+            heapq.heappush(self.free_ids, id_)
             if len(self.free_ids) == self.max_id + 1:
                 self.reset()
         finally:
@@ -233,25 +234,29 @@ def socketpair():
 
 def parse_ipv4(string, default_port=-1):
     """ Return (host, port) from IPv4 IP. """
-    split = string.split(':')
-    if len(split) == 1:
+    # Slicing around the colon avoids building a list as split does.
+    colon = string.find(':')
+    if colon == -1:
         return string, default_port
-    elif len(split) == 2:
-        return split[0], int(split[1])
+    elif string.find(':', colon + 1) == -1:
+        return string[:colon], int(string[colon + 1:])
     else:
         raise ValueError("Cannot interpret %r as IPv4 address!" % string)
 
 
 def parse_ipv6(string, default_port=-1):
     """ Return (host, port) from IPv6 IP. """
-    if '[' in string and ']' in string:
-        split = string.split(']:')
-        if len(split) == 1:
-            return string[1: -1], default_port
-        else:
-            return split[0][1:], int(split[1])
-    elif not '[' in string and not ']' in string:
+    bracket = string.find(']')
+    if bracket == -1:
+        if '[' in string:
+            raise ValueError("Cannot interpret %r as IPv6 address!" % string)
         return string, default_port
+    elif '[' not in string:
+        raise ValueError("Cannot interpret %r as IPv6 address!" % string)
+    elif bracket == len(string) - 1:
+        return string[1:-1], default_port
+    elif string[bracket + 1] == ':':
+        return string[1:bracket], int(string[bracket + 2:])
     else:
         raise ValueError("Cannot interpret %r as IPv6 address!" % string)
 
@@ -267,7 +272,8 @@ def parse_ip(string, default_port=-1):
     >>> parse_ip('[2001:0db8:85a3:08d3:1319:8a2e:0370:7344]:443')
     ('2001:0db8:85a3:08d3:1319:8a2e:0370:7344', 443)
     """
-    if string.count(':') > 1:
+    # Unlike counting the colons, this stops at the first and last one.
+    if string.find(':') != string.rfind(':'):
         return parse_ipv6(string, default_port)
     else:
         return parse_ipv4(string, default_port)
@@ -284,7 +290,9 @@ def goodsize(maxsize):
         the value of bufsize should be a relatively small power of 2,
         for example, 4096.
 """
-    return 2 ** math.floor(math.log(maxsize, 2))
+    if maxsize < 1:
+        raise ValueError("maxsize must be at least 1.")
+    return 1 << (int(maxsize).bit_length() - 1)
 
 
 def is_closed(sock):